@@ -0,0 +1,165 @@
+'''
+  JSON codec used by the web API, websockets and JSON-RPC, binary codecs of the WebSocket subprotocols
+------------------------------------------
+'''
+import json
+from collections import OrderedDict
+
+from log import *
+
+backend = 'json'
+binary = OrderedDict()      # WebSocket subprotocol -> BinaryCodec, only for the installed libraries
+
+# Binary subprotocols send field names and device types as their index in these tables
+# Names may only be appended, clients decode by position (the tables are sent on {"cmd":"keys"})
+BINARY_FIELDS = ('dev', 'circuit', 'value', 'glob_dev_id', 'alias', 'mode', 'modes', 'unit', 'range', 'range_modes',
+                 'counter', 'counter_mode', 'counter_modes', 'debounce', 'bitvalue', 'pending', 'relay_type', 'address',
+                 'lost', 'time', 'interval', 'typ', 'last_comm', 'conf_value', 'timeout', 'was_wd_reset', 'model',
+                 'sn', 'ap_state', 'ip')
+# devtype_names of devices.py, followed by the 'dev' values not found there
+BINARY_DEVS = ('relay', 'input', 'ai', 'ao', 'ee', 'sensor', 'i2cbus', 'adchip', 'owbus', 'mcp', 'gpiobus', 'pca9685',
+               'ds2408', 'unipi2', 'uart', 'neuron', 'board', 'misc_output', 'led', 'watchdog', 'register', 'wifi',
+               'light_channel', 'light_device', 'unit_register', 'ext_config', 'temp', '1wdevice', 'extension', 'wd')
+
+_field_index = dict((name, index) for (index, name) in enumerate(BINARY_FIELDS))
+_dev_index = dict((name, index) for (index, name) in enumerate(BINARY_DEVS))
+
+
+def _json_dumps(obj, sort_keys=False):
+    return json.dumps(obj, sort_keys=sort_keys)
+
+_dumps = _json_dumps
+_loads = json.loads
+
+
+def _use_ujson():
+    import ujson
+    kwargs = {'escape_forward_slashes': False}
+    try:
+        ujson.dumps(0.5, double_precision=15, **kwargs)    # older versions round floats to 9 digits by default
+        kwargs['double_precision'] = 15
+    except TypeError:
+        pass
+    def ujson_dumps(obj, sort_keys=False):
+        return ujson.dumps(obj, sort_keys=sort_keys, **kwargs)
+    try:
+        ujson.loads('0.5', precise_float=True)    # older versions parse floats imprecisely by default
+        def ujson_loads(data):
+            return ujson.loads(data, precise_float=True)
+    except TypeError:
+        ujson_loads = ujson.loads
+    return (ujson_dumps, ujson_loads)
+
+
+def _use_rapidjson():
+    import rapidjson
+    def rapidjson_dumps(obj, sort_keys=False):
+        return rapidjson.dumps(obj, sort_keys=sort_keys)
+    return (rapidjson_dumps, rapidjson.loads)
+
+
+backends = OrderedDict([
+    ('ujson', _use_ujson),
+    ('rapidjson', _use_rapidjson),
+])
+
+
+def _use_msgpack():
+    import msgpack
+    try:
+        msgpack.unpackb(msgpack.packb(u'a', use_bin_type=True), raw=False)
+        unpack_kwargs = {'raw': False}
+    except TypeError:
+        unpack_kwargs = {'encoding': 'utf-8'}      # before msgpack 0.5.2
+    def msgpack_dumps(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+    def msgpack_loads(data):
+        return msgpack.unpackb(data, **unpack_kwargs)
+    return (msgpack_dumps, msgpack_loads)
+
+
+def _use_cbor():
+    import cbor2
+    return (cbor2.dumps, cbor2.loads)
+
+
+binary_backends = OrderedDict([
+    ('evok.msgpack', _use_msgpack),
+    ('evok.cbor', _use_cbor),
+])
+
+
+class BinaryCodec(object):
+    """ Encoder of a binary WebSocket subprotocol, device lists are sent compacted by compact() """
+    def __init__(self, subprotocol, dumps, loads):
+        self.subprotocol = subprotocol
+        self.dumps = dumps
+        self.loads = loads
+
+    def dumps_devices(self, devices):
+        return self.dumps([compact(dev_full) for dev_full in devices])
+
+
+def _text(value):
+    """ Byte strings (str of python 2) would be sent as binary, text is expected by the clients """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, (list, tuple)):
+        return [_text(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_text(key), _text(item)) for (key, item) in value.items())
+    return value
+
+
+def compact(dev_full):
+    """ Replaces field names and the device type of a full() by their indexes in BINARY_FIELDS and BINARY_DEVS
+          A list of full() (e.g. of a Proxy or circuit "all") is compacted item by item
+    """
+    if isinstance(dev_full, (list, tuple)):
+        return [compact(single_full) for single_full in dev_full]
+    outp = {}
+    for (key, value) in dev_full.items():
+        if key == 'dev':
+            value = _dev_index.get(value, value)
+        outp[_field_index.get(key, _text(key))] = _text(value)
+    return outp
+
+
+def configure(name='auto'):
+    """ Selects the encoder: 'auto' takes the first installed of ujson and rapidjson, 'json' the standard library """
+    global backend, _dumps, _loads
+    if name == 'auto':
+        candidates = backends.keys()
+    elif name in backends:
+        candidates = [name]
+    else:
+        candidates = []
+    for candidate in candidates:
+        try:
+            (_dumps, _loads) = backends[candidate]()
+            backend = candidate
+            break
+        except ImportError:
+            if name != 'auto':
+                logger.warning("JSON codec %s is not installed, using the standard library", candidate)
+    else:
+        (backend, _dumps, _loads) = ('json', _json_dumps, json.loads)
+    logger.info("Using JSON codec %s", backend)
+    binary.clear()
+    for (subprotocol, use_backend) in binary_backends.items():
+        try:
+            binary[subprotocol] = BinaryCodec(subprotocol, *use_backend())
+        except ImportError:
+            pass
+
+
+def dumps(obj, sort_keys=False):
+    try:
+        return _dumps(obj, sort_keys=sort_keys)
+    except (TypeError, ValueError, OverflowError):
+        # Values the fast encoders refuse (NaN, big integers, ...) are left to the standard library
+        return json.dumps(obj, sort_keys=sort_keys)
+
+
+def loads(data):
+    return _loads(data)
@@ -364,9 +364,10 @@ def create_devices(Config, hw_dict):
                 scanfreq = Config.getfloatdef(section, "scan_frequency", 1)
                 scan_enabled = Config.getbooldef(section, "scan_enabled", True)
                 allow_register_access = Config.getbooldef(section, "allow_register_access", False)
+                pipeline_window = Config.getintdef(section, "pipeline_window", 1)
                 circuit = Config.getintdef(section, "global_id", 2)
                 neuron = Neuron(circuit, Config, modbus_server, modbus_port, scanfreq, scan_enabled, hw_dict, direct_access=allow_register_access,
-                                dev_id=dev_counter)
+                                dev_id=dev_counter, pipeline_window=pipeline_window)
                 Devices.register_device(NEURON, neuron)
             elif devclass == 'EXTENSION':
                 from neuron import UartNeuron
@@ -396,10 +397,14 @@ def create_devices(Config, hw_dict):
                 modbus_address = Config.getintdef(section, "address", 1)
                 device_name = Config.getstringdef(section, "device_name", "unspecified")
                 allow_register_access = Config.getbooldef(section, "allow_register_access", False)
+                pipeline_window = Config.getintdef(section, "pipeline_window", 1)
+                modbus_sockets = Config.getintdef(section, "modbus_sockets", 1)
+                modbus_request_timeout = Config.getfloatdef(section, "modbus_request_timeout", 5.0)
                 circuit = Config.getintdef(section, "global_id", 2)
                 neuron = TcpNeuron(circuit, Config, modbus_server, modbus_port, scanfreq, scan_enabled, hw_dict,
                                     device_name=device_name, modbus_address=modbus_address,
-                                    direct_access=allow_register_access, dev_id=dev_counter)
+                                    direct_access=allow_register_access, dev_id=dev_counter, pipeline_window=pipeline_window,
+                                    modbus_sockets=modbus_sockets, modbus_request_timeout=modbus_request_timeout)
                 Devices.register_device(NEURON, neuron)
 
         except Exception, E:
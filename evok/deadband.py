@@ -0,0 +1,110 @@
+'''
+  Deadband and minimum interval filtering of analog status events
+------------------------------------------
+'''
+import time
+import tornado.ioloop
+
+from devices import *
+
+# Device types filtered, with the prefix of their evok.conf defaults ([MAIN] <prefix>_deadband, ...)
+DEADBAND_TYPES = {AI: 'ai', UNIT_REGISTER: 'unit_register', SENSOR: 'sensor'}
+
+
+class Deadband(object):
+    """ Last reported value of one device and the limits for reporting the next one
+          abs_band and rel_band (fraction of the last reported value) - the larger one applies,
+          min_interval - seconds between two events of the device
+    """
+    def __init__(self, abs_band=0.0, rel_band=0.0, min_interval=0.0):
+        self.abs_band = abs_band
+        self.rel_band = rel_band
+        self.min_interval = min_interval
+        self.reported_value = None
+        self.reported_lost = False
+        self.reported_time = None
+        self.timer = None                   # pending report of a value held back by min_interval
+
+    def passes(self, value, lost=False):
+        """ True if the value moved out of the band around the last reported value """
+        if self.reported_time is None or lost != self.reported_lost:
+            return True
+        try:
+            band = max(self.abs_band, self.rel_band * abs(self.reported_value))
+            return abs(value - self.reported_value) > band
+        except TypeError:
+            # Tuples of multi-value sensors, None of a sensor not read yet
+            return value != self.reported_value
+
+    def report(self, value, lost, now):
+        self.reported_value = value
+        self.reported_lost = lost
+        self.reported_time = now
+
+
+class DeadbandFilter(object):
+    """ Drops status events of analog devices whose value stays within their deadband
+          and holds back events coming sooner than min_interval after the previous one;
+          a held back device is handed to emit() once the interval is over, with its value at that time.
+          Defaults per type are read from [MAIN], single devices from [DEADBAND_<TYPE>_<circuit>] sections
+          (e.g. [DEADBAND_AI_1_01]) with the keys deadband, deadband_relative and min_interval.
+    """
+    def __init__(self, Config, emit):
+        self.Config = Config
+        self.emit = emit
+        self.deadbands = {}                 # device -> Deadband, None for unfiltered devices
+        self.defaults = {}
+        for (devtype, prefix) in DEADBAND_TYPES.items():
+            self.defaults[devtype] = (Config.getfloatdef('MAIN', prefix + '_deadband', 0),
+                                      Config.getfloatdef('MAIN', prefix + '_deadband_relative', 0),
+                                      Config.getfloatdef('MAIN', prefix + '_min_interval', 0))
+        self.enabled = (any(sum(limits) > 0 for limits in self.defaults.values())
+                        or any(section.startswith('DEADBAND_') for section in Config.sections()))
+
+    def deadband(self, device):
+        if device not in self.deadbands:
+            deadband = None
+            devtype = getattr(device, 'devtype', None)
+            if devtype in DEADBAND_TYPES and hasattr(device, 'value'):
+                section = 'DEADBAND_%s_%s' % (devtype_names[devtype].upper(), device.circuit)
+                (abs_band, rel_band, min_interval) = self.defaults[devtype]
+                abs_band = self.Config.getfloatdef(section, 'deadband', abs_band)
+                rel_band = self.Config.getfloatdef(section, 'deadband_relative', rel_band)
+                min_interval = self.Config.getfloatdef(section, 'min_interval', min_interval)
+                if abs_band > 0 or rel_band > 0 or min_interval > 0:
+                    deadband = Deadband(abs_band, rel_band, min_interval)
+            self.deadbands[device] = deadband
+        return self.deadbands[device]
+
+    def filter(self, devices):
+        """ Returns the devices of one status event whose change is to be reported now """
+        if not self.enabled:
+            return devices
+        outp = []
+        now = time.time()
+        for device in devices:
+            deadband = self.deadband(device)
+            if deadband is None:
+                outp += [device]
+                continue
+            value = device.value
+            lost = getattr(device, 'lost', False)
+            if not deadband.passes(value, lost):
+                continue
+            if deadband.reported_time is not None and now - deadband.reported_time < deadband.min_interval:
+                if deadband.timer is None:
+                    deadband.timer = tornado.ioloop.IOLoop.instance().call_later(deadband.reported_time + deadband.min_interval - now,
+                                                                                 self.release, device)
+                continue
+            deadband.report(value, lost, now)
+            outp += [device]
+        return outp
+
+    def release(self, device):
+        deadband = self.deadbands[device]
+        deadband.timer = None
+        value = device.value
+        lost = getattr(device, 'lost', False)
+        if deadband.passes(value, lost):
+            deadband.report(value, lost, time.time())
+            self.emit(device)
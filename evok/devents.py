@@ -1,5 +1,147 @@
 #!/usr/bin/python
 
+import codec
+
+
+class StatusEvent(object):
+    """ One status event shared by all its consumers
+          full() of the changed devices and its JSON encodings are evaluated lazily and at most once
+    """
+    def __init__(self, device):
+        self.device = device
+        self.result = None
+        self.encoded = {}
+        self.packed_cache = {}
+        self.subscribed_cache = {}
+        self.device_fulls = {}
+
+    @property
+    def devices(self):
+        if hasattr(self.device, 'changeset'):
+            return self.device.changeset
+        return [self.device]
+
+    def full(self):
+        """ Returns device.full() as it is - a list for a Proxy, a dict for a single device """
+        if self.result is None:
+            self.result = self.device.full()
+        return self.result
+
+    def full_list(self):
+        dev_all = self.full()
+        if 'dev' in dev_all:
+            return [dev_all]
+        return dev_all
+
+    def json(self, dev_filter=None):
+        """ Returns the JSON encoding of full(), or of the list of devices with type in dev_filter (None if empty) """
+        key = None if dev_filter is None else tuple(dev_filter)
+        if key not in self.encoded:
+            if key is None:
+                self.encoded[key] = codec.dumps(self.full())
+            else:
+                outp = [single_dev for single_dev in self.full_list() if single_dev['dev'] in dev_filter]
+                self.encoded[key] = codec.dumps(outp) if len(outp) > 0 else None
+        return self.encoded[key]
+
+    def packed(self, binary, dev_filter=None):
+        """ Returns the encoding of the devices with type in dev_filter by a codec.BinaryCodec (None if empty)
+              The shape follows json() - without dev_filter full() is encoded as it is, a single device as an object
+        """
+        key = (binary.subprotocol, None if dev_filter is None else tuple(dev_filter))
+        if key not in self.packed_cache:
+            if dev_filter is None:
+                self.packed_cache[key] = binary.dumps(codec.compact(self.full()))
+            else:
+                outp = [single_dev for single_dev in self.full_list() if single_dev['dev'] in dev_filter]
+                self.packed_cache[key] = binary.dumps_devices(outp) if len(outp) > 0 else None
+        return self.packed_cache[key]
+
+    def subscribed(self, subscription, binary=None):
+        """ Returns the encoding (JSON, or by a codec.BinaryCodec) of the devices matching a Subscription, None if empty
+              full() is evaluated only for the matching devices
+        """
+        key = (subscription.key, None if binary is None else binary.subprotocol)
+        if key not in self.subscribed_cache:
+            outp = []
+            for single_dev in self.devices:
+                if subscription.matches(single_dev):
+                    if single_dev not in self.device_fulls:
+                        self.device_fulls[single_dev] = single_dev.full()
+                    outp += [subscription.project(self.device_fulls[single_dev])]
+            if len(outp) == 0:
+                self.subscribed_cache[key] = None
+            elif binary is not None:
+                self.subscribed_cache[key] = binary.dumps_devices(outp)
+            else:
+                self.subscribed_cache[key] = codec.dumps(outp)
+        return self.subscribed_cache[key]
+
+
+class BatchTick(object):
+    """ Devices flushed to the batching WebSocket clients at one tick
+          full() of every device and the encoding for every filter/subscription are evaluated at most once per tick
+    """
+    def __init__(self):
+        self.device_fulls = {}
+        self.encoded = {}
+
+    def full(self, device):
+        if device not in self.device_fulls:
+            self.device_fulls[device] = device.full()
+        return self.device_fulls[device]
+
+    def encode(self, devices, dev_filter=None, subscription=None, binary=None):
+        """ Returns the encoding (JSON, or by a codec.BinaryCodec) of the devices passing dev_filter
+              or matching a Subscription, None if empty
+        """
+        key = (tuple(devices), None if dev_filter is None else tuple(dev_filter),
+               None if subscription is None else subscription.key, None if binary is None else binary.subprotocol)
+        if key not in self.encoded:
+            outp = []
+            for single_dev in devices:
+                if subscription is not None:
+                    if subscription.matches(single_dev):
+                        outp += [subscription.project(self.full(single_dev))]
+                    continue
+                dev_full = self.full(single_dev)
+                if dev_filter is None or dev_full['dev'] in dev_filter:
+                    outp += [dev_full]
+            if len(outp) == 0:
+                self.encoded[key] = None
+            elif binary is not None:
+                self.encoded[key] = binary.dumps_devices(outp)
+            else:
+                self.encoded[key] = codec.dumps(outp)
+        return self.encoded[key]
+
+
+class Subscription(object):
+    """ Compiled WebSocket subscription, decides from device attributes alone whether a device is wanted
+          A device matches if its type, (type, circuit), (type, major_group) or alias is listed;
+          with fields, only these fields of full() are sent (with 'dev' and 'circuit' always included)
+    """
+    def __init__(self, devtypes=(), circuits=(), groups=(), aliases=(), fields=None):
+        self.devtypes = frozenset(devtypes)
+        self.circuits = frozenset((devtype, str(circuit)) for (devtype, circuit) in circuits)
+        self.groups = frozenset(groups)
+        self.aliases = frozenset(aliases)
+        if fields is not None:
+            fields = ('dev', 'circuit') + tuple(field for field in fields if field not in ('dev', 'circuit'))
+        self.fields = fields
+        self.key = (self.devtypes, self.circuits, self.groups, self.aliases, self.fields)
+
+    def matches(self, device):
+        devtype = device.devtype
+        return (devtype in self.devtypes or (devtype, str(device.circuit)) in self.circuits
+                or (devtype, getattr(device, 'major_group', None)) in self.groups
+                or getattr(device, 'alias', None) in self.aliases)
+
+    def project(self, dev_full):
+        if self.fields is None:
+            return dev_full
+        return dict((field, dev_full[field]) for field in self.fields if field in dev_full)
+
 
 def _status(device, **kwarg):
     #print device.full()
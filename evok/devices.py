@@ -16,6 +16,8 @@ class DeviceList(dict):
         super(DeviceList, self).__init__()
         self._arr = []
         self.altnames = altnames
+        self._by_group = {}     # (devtypeid, major_group) -> {circuit: device}
+        self._by_dev_id = {}    # (devtypeid, dev_id) -> {circuit: device}
 
     def __setitem__(self, key, value):
         if not (key in self.keys()): self._arr.append(value)
@@ -27,36 +29,64 @@ class DeviceList(dict):
         except KeyError:
             return super(DeviceList, self).__getitem__(self.altnames[key])
 
+    def type_id(self, devtype):
+        """ Returns the INTEGER type of a device type given as INTEGER, NAME or alternative name """
+        if type(devtype) is int:
+            return devtype
+        if devtype in self.altnames:
+            devtype = self.altnames[devtype]
+        return devtype_names.index(devtype)
+
+    def _index(self, devtypeid, device):
+        circuit = str(device.circuit)
+        if hasattr(device, 'major_group'):
+            self._by_group.setdefault((devtypeid, device.major_group), {})[circuit] = device
+        if hasattr(device, 'dev_id'):
+            self._by_dev_id.setdefault((devtypeid, device.dev_id), {})[circuit] = device
+
+    def _unindex(self, devtypeid, device):
+        circuit = str(device.circuit)
+        for (index, key) in ((self._by_group, (devtypeid, getattr(device, 'major_group', None))),
+                             (self._by_dev_id, (devtypeid, getattr(device, 'dev_id', None)))):
+            if key in index and index[key].get(circuit) is device:
+                del index[key][circuit]
+                if len(index[key]) == 0:
+                    del index[key]
+
     def remove_item(self, key, value):
-        del (self[devtype_names[key]])[value.circuit]
+        self._unindex(key, value)
+        del (self[devtype_names[key]])[str(value.circuit)]
 
     def remove_global_device(self, glob_dev_id):
-        for devtype_name in devtype_names:
-            to_delete = []
-            for dev_name in self[devtype_name]:
-                if ((self[devtype_name])[dev_name]).dev_id == glob_dev_id:
-                    to_delete += [(self[devtype_name])[dev_name]]
-            for value in to_delete:
-                del (self[devtype_name])[value.circuit]
+        for devtypeid in range(len(devtype_names)):
+            for value in self._by_dev_id.get((devtypeid, glob_dev_id), {}).values():
+                self.remove_item(devtypeid, value)
+
+    def by_dev_id(self, devtypeid, dev_id):
+        return self._by_dev_id.get((devtypeid, dev_id), {}).values()
+
+    def query(self, devtype, major_group=None, circuits=None, dev_id=None):
+        """ Returns devices of devtype (INTEGER or NAME) matching all given criteria, narrowed by the secondary indexes """
+        devtypeid = self.type_id(devtype)
+        if major_group is not None:
+            candidates = self._by_group.get((devtypeid, major_group), {})
+        elif dev_id is not None:
+            candidates = self._by_dev_id.get((devtypeid, dev_id), {})
+        else:
+            candidates = self._arr[devtypeid]
+        if circuits is not None:
+            outp = [candidates[str(circuit)] for circuit in circuits if str(circuit) in candidates]
+        else:
+            outp = candidates.values()
+        if dev_id is not None and major_group is not None:
+            outp = [single_dev for single_dev in outp if single_dev.dev_id == dev_id]
+        return outp
 
     def by_int(self, devtypeid, circuit=None, major_group=None):
         devdict = self._arr[devtypeid]
         if circuit is None:
             if major_group is not None:
-                outp = []
-                if len(devdict.values()) > 1:
-                    for single_dev in devdict.values():
-                        if single_dev.major_group == major_group:
-                            outp += [single_dev]
-                    return outp
-                elif len(devdict.values()) > 0:
-                    single_dev = devdict.values()[0]
-                    if single_dev.major_group == major_group:
-                        return devdict.values()
-                    else:
-                        return []
-                else:
-                    return []
+                return self._by_group.get((devtypeid, major_group), {}).values()
             else:
                 return devdict.values()
         try:
@@ -87,11 +117,12 @@ class DeviceList(dict):
         """
         if devtype is None:
             raise Exception('Device type must contain INTEGER or NAME')
-        if type(devtype) is int:
-            devdict = self._arr[devtype]
-        else:
-            devdict = self[devtype]
+        devtypeid = self.type_id(devtype)
+        devdict = self._arr[devtypeid]
+        if str(device.circuit) in devdict:
+            self._unindex(devtypeid, devdict[str(device.circuit)])
         devdict[str(device.circuit)] = device
+        self._index(devtypeid, device)
         devents.config(device)
 
     def add_alias(self, alias_key, device, file_update=False):
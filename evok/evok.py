@@ -14,6 +14,7 @@ from operator import methodcaller
 from tornado import gen
 from tornado.options import define, options
 from tornado import websocket
+from tornado.websocket import WebSocketClosedError
 from tornado import escape
 from tornado.concurrent import is_future
 from tornado.gen import Return
@@ -37,6 +38,7 @@ import signal
 
 import json
 import config
+import codec
 from devices import *
 
 from tornado_json.requesthandlers import APIHandler
@@ -59,9 +61,36 @@ cors = False
 corsdomains = '*'
 use_output_schema = Config.getbooldef('MAIN','use_schema_verification',False)
 allow_unsafe_configuration_handlers = Config.getbooldef('MAIN','allow_unsafe_configuration_handlers',False)
+ws_max_pending = Config.getintdef('MAIN','websocket_max_pending',64)
+ws_batch_ms = Config.getintdef('MAIN','websocket_batch_ms',0)
+
+codec.configure(Config.getstringdef('MAIN','json_codec','auto'))
 
 import rpc_handler
 import neuron
+import snapshot
+import deadband
+import webhook
+
+rest_all_max_age = Config.getfloatdef('MAIN','rest_all_max_age',1.0)
+rest_all_sorted_types = (EXT_CONFIG,) if Config.getbooldef('MAIN','json_sort_ext_config',True) else ()
+rest_all_snapshot = snapshot.DeviceSnapshot((INPUT, RELAY, AI, AO, SENSOR, LED, WATCHDOG, NEURON, UART, REGISTER, WIFI, LIGHT_CHANNEL, OWBUS,
+                                             UNIT_REGISTER, EXT_CONFIG), sorted_types=rest_all_sorted_types, max_age=rest_all_max_age)
+json_all_snapshot = snapshot.DeviceSnapshot((INPUT, RELAY, OUTPUT, AI, AO, SENSOR, LED, WATCHDOG, NEURON, UART, REGISTER, WIFI, LIGHT_CHANNEL,
+                                             UNIT_REGISTER, EXT_CONFIG), max_age=rest_all_max_age)
+change_log = snapshot.ChangeLog(Config.getintdef('MAIN','rest_changes_buffer',1024))
+
+def invalidate_snapshots():
+    """ Drops the cached /rest/all and /json/all bodies; alias and configuration changes raise no status event """
+    rest_all_snapshot.invalidate()
+    json_all_snapshot.invalidate()
+
+
+class InvalidateOnPost():
+    def on_finish(self):
+        if self.request.method == 'POST':
+            invalidate_snapshots()
+
 
 class UserCookieHelper():
     _passwords = []
@@ -116,13 +145,32 @@ def enable_cors(handler):
 #    def get(self):
 #        self.render(self.index)
 registered_ws = {}
+batch_waiting = {}      # batch_ms -> set of WsHandler clients with devices waiting for the next tick
+
+
+def schedule_batch(client):
+    """ Adds a client to the next tick of its batch_ms; clients sharing a tick share full() and encodings """
+    waiting = batch_waiting.get(client.batch_ms)
+    if waiting is None:
+        waiting = batch_waiting[client.batch_ms] = set()
+        tornado.ioloop.IOLoop.instance().call_later(client.batch_ms / 1000.0, flush_batches, client.batch_ms)
+    waiting.add(client)
+    return client.batch_ms
+
+
+def flush_batches(batch_ms):
+    tick = devents.BatchTick()
+    for client in batch_waiting.pop(batch_ms, ()):
+        client.flush_batch(tick)
+
 
 class WhHandler():
-    def __init__(self, url, allowed_types, complex_events):
-        self.http_client = tornado.httpclient.AsyncHTTPClient()
+    def __init__(self, url, allowed_types, complex_events, subscription=None, **delivery):
         self.url = url
         self.allowed_types = allowed_types
         self.complex_events = complex_events
+        self.subscription = subscription    # devents.Subscription of a [WEBHOOK_*] target, replaces allowed_types
+        self.delivery = webhook.WebhookQueue(url, complex_events, **delivery)
 
     def open(self):
         logger.debug("New WebSocket modbusclient_rs485 connected")
@@ -131,23 +179,20 @@ class WhHandler():
 
         registered_ws["all"].add(self)
 
-    def on_event(self, device):
-        dev_all = device.full()
-        outp = []
-        for single_dev in dev_all:
-            if single_dev['dev'] in self.allowed_types:
-                outp += [single_dev]
+    def on_event(self, event):
         try:
-            if len(outp) > 0:
-                if not self.complex_events:
-                    self.http_client.fetch(self.url,method="GET")
-                else:
-                    self.http_client.fetch(self.url,method="POST",body=json.dumps(outp))
+            if self.subscription is not None:
+                body = event.subscribed(self.subscription)
+            else:
+                body = event.json(self.allowed_types)
+            if body is not None:
+                self.delivery.put(body)
         except Exception,E:
             logger.exception(str(E))
 
 
 class WsHandler(websocket.WebSocketHandler):
+    binary = None       # codec.BinaryCodec of the negotiated subprotocol, None for JSON text frames
 
     def check_origin(self, origin):
         # fix issue when Node-RED removes the 'prefix://'
@@ -157,37 +202,146 @@ class WsHandler(websocket.WebSocketHandler):
         #return origin == host or origin_origin == host
         return True
 
+    def select_subprotocol(self, subprotocols):
+        for subprotocol in subprotocols:
+            if subprotocol in codec.binary:
+                self.binary = codec.binary[subprotocol]
+                return subprotocol
+        return None
+
     def open(self):
         self.filter = ["default"]
+        self.subscription = None        # devents.Subscription, replaces filter when set
+        self.pending = 0                # messages handed to the stream but not yet flushed to the socket
+        self.stale = OrderedDict()      # devices with events held back while the client is behind, latest value wins
+        self.coalesced = 0
+        self.batch_ms = ws_batch_ms     # events are collected for this long and sent as one frame, 0 disables batching
+        self.batch = OrderedDict()
+        self.batch_tick = None          # batch_ms of the tick the waiting batch is flushed at
         logger.debug("New WebSocket client connected")
         if not registered_ws.has_key("all"):
             registered_ws["all"] = set()
 
         registered_ws["all"].add(self)
 
-    def on_event(self, device):
-        dev_all = device.full()
-        outp = []
+    def on_event(self, event):
+        """ Queues one status event, its encoding is shared by all clients with the same filter/subscription """
         try:
-            if len(self.filter) == 1 and self.filter[0] == "default":
-                self.write_message(json.dumps(device.full()))
+            devices = event.devices
+            if self.subscription is not None:
+                devices = [single_dev for single_dev in devices if self.subscription.matches(single_dev)]
+                if len(devices) == 0:
+                    return
+            if self.batch_ms > 0:
+                for single_dev in devices:
+                    self.batch[(single_dev.devtype, single_dev.circuit)] = single_dev
+                if self.batch_tick is None:
+                    self.batch_tick = schedule_batch(self)
+                return
+            dev_filter = None if (len(self.filter) == 1 and self.filter[0] == "default") else self.filter
+            if self.subscription is not None:
+                message = event.subscribed(self.subscription, self.binary)
+            elif self.binary is not None:
+                message = event.packed(self.binary, dev_filter)
             else:
-                if 'dev' in dev_all:
-                    dev_all = [dev_all]
-                for single_dev in dev_all:
-                    if single_dev['dev'] in self.filter:
-                        outp += [single_dev]
-                if len(outp) > 0:
-                    self.write_message(json.dumps(outp))
+                message = event.json(dev_filter)
+            if message is None:
+                return
+            if self.pending >= ws_max_pending:
+                # Slow consumer, keep only the devices and send their current state once the socket drains
+                for single_dev in devices:
+                    self.stale[(single_dev.devtype, single_dev.circuit)] = single_dev
+                self.coalesced += 1
+            else:
+                self.send_queued(message)
         except Exception as e:
             logger.error("Exc: %s", str(e))
             pass
 
+    def send_queued(self, message):
+        try:
+            future = self.write_message(message, binary=self.binary is not None)
+        except WebSocketClosedError:
+            return
+        self.pending += 1
+        future.add_done_callback(self.on_flushed)
+
+    def on_flushed(self, future):
+        self.pending -= 1
+        if len(self.stale) > 0 and self.pending == 0:
+            stale = self.stale.values()
+            self.stale = OrderedDict()
+            self.send_devices(stale)
+
+    def flush_batch(self, tick):
+        self.batch_tick = None
+        batch = self.batch
+        self.batch = OrderedDict()
+        if self.pending >= ws_max_pending:
+            self.stale.update(batch)
+            self.coalesced += 1
+        else:
+            try:
+                self.send_devices(batch.values(), tick)
+            except Exception as e:
+                logger.error("Exc: %s", str(e))
+
+    def send_devices(self, devices, tick=None):
+        """ Sends the current state of devices passing the filter as one JSON (or binary subprotocol) array
+              full() and the encoding are shared with the other clients flushed at the same devents.BatchTick
+        """
+        if tick is None:
+            tick = devents.BatchTick()
+        dev_filter = None if (len(self.filter) == 1 and self.filter[0] == "default") else self.filter
+        message = tick.encode(devices, dev_filter, self.subscription, self.binary)
+        if message is not None:
+            self.send_queued(message)
+
+    def subscribe(self, message):
+        """ Compiles {"cmd":"subscribe"} into a devents.Subscription, a message without any selection removes it
+              {"cmd":"subscribe", "devices":["ai"], "circuits":{"input":["1_01","1_02"]}, "groups":{"relay":[2]},
+               "aliases":["al_door"], "fields":["value"]}
+        """
+        circuits = []
+        for (devtype, circuit_list) in message.get("circuits", {}).items():
+            circuits += [(Devices.type_id(str(devtype)), str(circuit)) for circuit in circuit_list]
+        groups = []
+        for (devtype, group_list) in message.get("groups", {}).items():
+            groups += [(Devices.type_id(str(devtype)), int(major_group)) for major_group in group_list]
+        devtypes = [Devices.type_id(str(devtype)) for devtype in message.get("devices", [])]
+        aliases = [str(alias) for alias in message.get("aliases", [])]
+        fields = message.get("fields")
+        if fields is not None:
+            fields = [str(field) for field in fields]
+        if len(devtypes) + len(circuits) + len(groups) + len(aliases) == 0:
+            self.subscription = None
+        else:
+            self.subscription = devents.Subscription(devtypes, circuits, groups, aliases, fields)
+
+    def write_reply(self, data):
+        if self.binary is not None:
+            self.write_message(self.binary.dumps(data), binary=True)
+        else:
+            self.write_message(codec.dumps(data))
+
+    def stats(self):
+        return {'remote_ip': self.request.remote_ip,
+                'filter': self.filter,
+                'subscribed': self.subscription is not None,
+                'pending': self.pending,
+                'stale_devices': len(self.stale),
+                'coalesced_events': self.coalesced,
+                'batch_ms': self.batch_ms,
+                'subprotocol': None if self.binary is None else self.binary.subprotocol}
+
 
     @tornado.gen.coroutine
     def on_message(self, message):
         try:
-            message = json.loads(message)
+            if self.binary is not None and isinstance(message, bytes):
+                message = self.binary.loads(message)
+            else:
+                message = codec.loads(message)
             try:
                 cmd = message["cmd"]
             except:
@@ -197,23 +351,26 @@ class WsHandler(websocket.WebSocketHandler):
                 result = []
                 #devices = [INPUT, RELAY, AI, AO, SENSOR, UNIT_REGISTER]
                 devices = [INPUT, RELAY, AI, AO, SENSOR]
+                dev_filter = None
                 if Config.getbooldef("MAIN", "websocket_all_filtered", False):
-                    if (len(self.filter) == 1 and self.filter[0] == "default"):
+                    if self.subscription is not None:
+                        for dev in range(0,25):
+                            result += [single_dev for single_dev in Devices.by_int(dev) if self.subscription.matches(single_dev)]
+                    elif (len(self.filter) == 1 and self.filter[0] == "default"):
                         for dev in devices:
-                            result += map(lambda dev: dev.full(), Devices.by_int(dev))
+                            result += Devices.by_int(dev)
                     else:
                         for dev in range(0,25):
-                            added_results = map(lambda dev: dev.full() if dev.full() is not None else '', Devices.by_int(dev))
-                            for added_result in added_results:
-                                if added_result != '' and added_result['dev'] in self.filter:
-                                    result.append(added_result)
+                            result += Devices.by_int(dev)
+                        dev_filter = self.filter
                 else:
                     for dev in range(0,25):
-                        added_results = map(lambda dev: dev.full() if dev.full() is not None else '', Devices.by_int(dev))
-                        for added_result in added_results:
-                            if added_result != '':
-                                result.append(added_result)
-                self.write_message(json.dumps(result))
+                        result += Devices.by_int(dev)
+                message = yield snapshot.encode_devices(result, dev_filter, self.binary)
+                self.write_message(message, binary=self.binary is not None)
+            #tables of the short keys used by the binary subprotocols
+            elif cmd == "keys":
+                self.write_reply({'fields': codec.BINARY_FIELDS, 'devs': codec.BINARY_DEVS})
             #set device state
             elif cmd == "filter":
                 devices = []
@@ -223,12 +380,23 @@ class WsHandler(websocket.WebSocketHandler):
                             devices += [single_dev]
                     if len(devices) > 0 or len(message["devices"]) == 0:
                         self.filter = devices
+                        self.subscription = None
                         if message["devices"][0] == "default":
                             self.filter = ["default"]
                     else:
                         raise Exception("Invalid 'devices' argument: %s" % str(message["devices"]))
                 except Exception,E:
                     logger.exception("Exc: %s", str(E))
+            elif cmd == "subscribe":
+                try:
+                    self.subscribe(message)
+                except Exception,E:
+                    logger.exception("Exc: %s", str(E))
+            elif cmd == "batch":
+                try:
+                    self.batch_ms = max(0, int(message["batch_ms"]))
+                except Exception,E:
+                    logger.exception("Exc: %s", str(E))
             elif cmd is not None:
                 dev = message["dev"]
                 circuit = message["circuit"]
@@ -253,8 +421,14 @@ class WsHandler(websocket.WebSocketHandler):
                             result = func()
                     if is_future(result):
                         result = yield result
+                    if cmd != "full":
+                        invalidate_snapshots()
                     if cmd == "full":
-                        self.write_message(json.dumps(result))
+                        # Same shape in all encodings: one device as an object, circuit "all" as a list
+                        if self.binary is not None:
+                            self.write_reply(codec.compact(result))
+                        else:
+                            self.write_reply(result)
                     #send response only to the modbusclient_rs485 requesting full info
                 #nebo except Exception as e:
                 except Exception, E:
@@ -266,6 +440,9 @@ class WsHandler(websocket.WebSocketHandler):
             pass
 
     def on_close(self):
+        if self.batch_tick is not None:
+            batch_waiting.get(self.batch_tick, set()).discard(self)
+            self.batch_tick = None
         if registered_ws.has_key("all") and (self in registered_ws["all"]):
             registered_ws["all"].remove(self)
             if len(registered_ws["all"]) == 0:
@@ -300,7 +477,7 @@ class LoginHandler(tornado.web.RequestHandler):
             return True
         return False
 
-class LegacyRestHandler(UserCookieHelper, tornado.web.RequestHandler):
+class LegacyRestHandler(UserCookieHelper, InvalidateOnPost, tornado.web.RequestHandler):
     def initialize(self):
         enable_cors(self)
         self.set_header("Access-Control-Allow-Origin", "*")
@@ -318,7 +495,7 @@ class LegacyRestHandler(UserCookieHelper, tornado.web.RequestHandler):
             result = {prop: getattr(device, prop)}
         else:
             result = device.full()
-        self.write(json.dumps(result))
+        self.write(codec.dumps(result))
         self.finish()
 
 
@@ -332,9 +509,9 @@ class LegacyRestHandler(UserCookieHelper, tornado.web.RequestHandler):
             result = device.set(**kw)
             if is_future(result):
                 result = yield result
-            self.write(json.dumps({'success': True, 'result': result}))
+            self.write(codec.dumps({'success': True, 'result': result}))
         except Exception, E:
-            self.write(json.dumps({'success': False, 'errors': {'__all__': str(E)}}))
+            self.write(codec.dumps({'success': False, 'errors': {'__all__': str(E)}}))
         self.set_header('Content-Type', 'application/json')
         self.finish()
 
@@ -343,7 +520,7 @@ class LegacyRestHandler(UserCookieHelper, tornado.web.RequestHandler):
         self.set_status(204)
         self.finish()
 
-class RestLightChannelHandler(UserCookieHelper, APIHandler):
+class RestLightChannelHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
@@ -384,7 +561,7 @@ class RestLightChannelHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("light_channel", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -400,7 +577,7 @@ class RestLightChannelHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("light_channel", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -414,7 +591,7 @@ class RestLightChannelHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class RestOWireHandler(UserCookieHelper, APIHandler):
+class RestOWireHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
@@ -455,7 +632,7 @@ class RestOWireHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("sensor", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -471,7 +648,7 @@ class RestOWireHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("sensor", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -485,7 +662,7 @@ class RestOWireHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class RestUARTHandler(UserCookieHelper, APIHandler):
+class RestUARTHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
@@ -526,7 +703,7 @@ class RestUARTHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("uart", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -542,7 +719,7 @@ class RestUARTHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("uart", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -556,7 +733,7 @@ class RestUARTHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class RestNeuronHandler(UserCookieHelper, APIHandler):
+class RestNeuronHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
@@ -597,7 +774,7 @@ class RestNeuronHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("neuron", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -613,7 +790,7 @@ class RestNeuronHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("neuron", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -627,7 +804,7 @@ class RestNeuronHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class RestLEDHandler(UserCookieHelper, APIHandler):
+class RestLEDHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
@@ -668,7 +845,7 @@ class RestLEDHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("led", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -684,7 +861,7 @@ class RestLEDHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("led", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -698,7 +875,7 @@ class RestLEDHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class RestWatchdogHandler(UserCookieHelper, APIHandler):
+class RestWatchdogHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
@@ -740,7 +917,7 @@ class RestWatchdogHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("watchdog", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -756,7 +933,7 @@ class RestWatchdogHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("watchdog", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -770,7 +947,7 @@ class RestWatchdogHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class RestRegisterHandler(UserCookieHelper, APIHandler):
+class RestRegisterHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
@@ -813,7 +990,7 @@ class RestRegisterHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("register", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -829,7 +1006,7 @@ class RestRegisterHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("register", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -843,7 +1020,7 @@ class RestRegisterHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class RestExtConfigHandler(UserCookieHelper, APIHandler):
+class RestExtConfigHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
@@ -886,7 +1063,7 @@ class RestExtConfigHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("ext_config", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -902,7 +1079,7 @@ class RestExtConfigHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("ext_config", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -916,7 +1093,7 @@ class RestExtConfigHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class RestUnitRegisterHandler(UserCookieHelper, APIHandler):
+class RestUnitRegisterHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
@@ -959,7 +1136,7 @@ class RestUnitRegisterHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("unit_register", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -975,7 +1152,7 @@ class RestUnitRegisterHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("unit_register", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -989,7 +1166,7 @@ class RestUnitRegisterHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class RestDIHandler(UserCookieHelper, APIHandler):
+class RestDIHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     post_out_example = {"result": 1, "success": True}
 
     def initialize(self):
@@ -1034,7 +1211,7 @@ class RestDIHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("input", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -1050,7 +1227,7 @@ class RestDIHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("input", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -1065,7 +1242,7 @@ class RestDIHandler(UserCookieHelper, APIHandler):
         self.finish()
 
 
-class RestOwbusHandler(UserCookieHelper, APIHandler):
+class RestOwbusHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         enable_cors(self)
         self.set_header("Access-Control-Allow-Origin", "*")
@@ -1108,7 +1285,7 @@ class RestOwbusHandler(UserCookieHelper, APIHandler):
             try:
                 device = Devices.by_name("owbus", circuit)
                 print(device)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.bus_driver.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -1124,7 +1301,7 @@ class RestOwbusHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("owbus", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.bus_driver.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -1139,7 +1316,7 @@ class RestOwbusHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class RestDOHandler(UserCookieHelper, APIHandler):
+class RestDOHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         enable_cors(self)
         self.set_header("Access-Control-Allow-Origin", "*")
@@ -1181,7 +1358,7 @@ class RestDOHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("output", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -1197,7 +1374,7 @@ class RestDOHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("output", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -1212,7 +1389,7 @@ class RestDOHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class RestWiFiHandler(UserCookieHelper, APIHandler):
+class RestWiFiHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         enable_cors(self)
         self.set_header("Access-Control-Allow-Origin", "*")
@@ -1254,7 +1431,7 @@ class RestWiFiHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("wifi", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -1270,7 +1447,7 @@ class RestWiFiHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("wifi", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -1284,7 +1461,7 @@ class RestWiFiHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class RestAIHandler(UserCookieHelper, APIHandler):
+class RestAIHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         enable_cors(self)
         self.set_header("Access-Control-Allow-Origin", "*")
@@ -1326,7 +1503,7 @@ class RestAIHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("ai", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -1342,7 +1519,7 @@ class RestAIHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("ai", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -1357,7 +1534,7 @@ class RestAIHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class RestAOHandler(UserCookieHelper, APIHandler):
+class RestAOHandler(UserCookieHelper, InvalidateOnPost, APIHandler):
     def initialize(self):
         enable_cors(self)
         self.set_header("Access-Control-Allow-Origin", "*")
@@ -1398,7 +1575,7 @@ class RestAOHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("ao", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -1414,7 +1591,7 @@ class RestAOHandler(UserCookieHelper, APIHandler):
         def post(self, circuit, prop):
             try:
                 device = Devices.by_name("ao", circuit)
-                js_dict = json.loads(self.request.body)
+                js_dict = codec.loads(self.request.body)
                 result = device.set(**js_dict)
                 if is_future(result):
                     result = yield result
@@ -1491,6 +1668,38 @@ class VersionHandler(UserCookieHelper, APIHandler):
         self.write(self.version)
         self.finish()
 
+class WsStatsHandler(UserCookieHelper, APIHandler):
+    def initialize(self):
+        enable_cors(self)
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.set_header("Access-Control-Allow-Headers", "x-requested-with")
+        self.set_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
+
+    def get(self):
+        """This function returns send queue depths of the connected websocket clients"""
+        clients = []
+        if registered_ws.has_key("all"):
+            clients = [client.stats() for client in registered_ws["all"] if isinstance(client, WsHandler)]
+        self.write(codec.dumps({'max_pending': ws_max_pending, 'clients': clients}))
+        self.set_header('Content-Type', 'application/json')
+        self.finish()
+
+class WhStatsHandler(UserCookieHelper, APIHandler):
+    def initialize(self):
+        enable_cors(self)
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.set_header("Access-Control-Allow-Headers", "x-requested-with")
+        self.set_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
+
+    def get(self):
+        """This function returns delivery counters of the webhooks"""
+        webhooks = []
+        if registered_ws.has_key("all"):
+            webhooks = [consumer.delivery.stats() for consumer in registered_ws["all"] if isinstance(consumer, WhHandler)]
+        self.write(codec.dumps({'webhooks': webhooks}))
+        self.set_header('Content-Type', 'application/json')
+        self.finish()
+
 @gen.coroutine
 def call_shell_subprocess(cmd, stdin_data=None, stdin_async=False):
     """
@@ -1527,24 +1736,11 @@ class JSONLoadAllHandler(UserCookieHelper, APIHandler):
 
     if not use_output_schema:
         @schema.validate(output_schema=schemas.all_get_out_schema)
+        @tornado.gen.coroutine
         def get(self):
             """This function returns a heterogeneous list of all devices exposed via the REST API"""
-            result = map(lambda dev: dev.full(), Devices.by_int(INPUT))
-            result += map(lambda dev: dev.full(), Devices.by_int(RELAY))
-            result += map(lambda dev: dev.full(), Devices.by_int(OUTPUT))
-            result += map(lambda dev: dev.full(), Devices.by_int(AI))
-            result += map(lambda dev: dev.full(), Devices.by_int(AO))
-            result += map(lambda dev: dev.full(), Devices.by_int(SENSOR))
-            result += map(lambda dev: dev.full(), Devices.by_int(LED))
-            result += map(lambda dev: dev.full(), Devices.by_int(WATCHDOG))
-            result += map(lambda dev: dev.full(), Devices.by_int(NEURON))
-            result += map(lambda dev: dev.full(), Devices.by_int(UART))
-            result += map(lambda dev: dev.full(), Devices.by_int(REGISTER))
-            result += map(lambda dev: dev.full(), Devices.by_int(WIFI))
-            result += map(lambda dev: dev.full(), Devices.by_int(LIGHT_CHANNEL))
-            result += map(lambda dev: dev.full(), Devices.by_int(UNIT_REGISTER))
-            result += map(lambda dev: dev.full(), Devices.by_int(EXT_CONFIG))
-            return result
+            result = yield json_all_snapshot.get_list()
+            raise Return(result)
     else:
         @schema.validate(output_schema=schemas.all_get_out_schema, output_example=schemas.all_get_out_example)
         def get(self):
@@ -1578,25 +1774,16 @@ class RestLoadAllHandler(UserCookieHelper, APIHandler):
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
         self.set_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
 
+    @tornado.gen.coroutine
     def get(self):
         """This function returns a heterogeneous list of all devices exposed via the REST API"""
-        result = map(lambda dev: dev.full(), Devices.by_int(INPUT))
-        result += map(lambda dev: dev.full(), Devices.by_int(RELAY))
-        result += map(lambda dev: dev.full(), Devices.by_int(AI))
-        result += map(lambda dev: dev.full(), Devices.by_int(AO))
-        result += map(lambda dev: dev.full(), Devices.by_int(SENSOR))
-        result += map(lambda dev: dev.full(), Devices.by_int(LED))
-        result += map(lambda dev: dev.full(), Devices.by_int(WATCHDOG))
-        result += map(lambda dev: dev.full(), Devices.by_int(NEURON))
-        result += map(lambda dev: dev.full(), Devices.by_int(UART))
-        result += map(lambda dev: dev.full(), Devices.by_int(REGISTER))
-        result += map(lambda dev: dev.full(), Devices.by_int(WIFI))
-        result += map(lambda dev: dev.full(), Devices.by_int(LIGHT_CHANNEL))
-        result += map(lambda dev: dev.full(), Devices.by_int(OWBUS))
-        result += map(lambda dev: dev.full(), Devices.by_int(UNIT_REGISTER))
-        result += map(lambda dev: OrderedDict(sorted(dev.full().items(), key=lambda t: t[0])), Devices.by_int(EXT_CONFIG)) # Sort for better reading
-        self.write(json.dumps(result))
+        parts, etag = yield rest_all_snapshot.get()
         self.set_header('Content-Type', 'application/json')
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+        else:
+            yield snapshot.write_devices(self, parts)
         self.finish()
 
     def options(self):
@@ -1604,7 +1791,43 @@ class RestLoadAllHandler(UserCookieHelper, APIHandler):
         self.set_status(204)
         self.finish()
 
-class JSONBulkHandler(APIHandler):
+class RestChangesHandler(UserCookieHelper, APIHandler):
+    max_wait = 60
+
+    def initialize(self):
+        enable_cors(self)
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.set_header("Access-Control-Allow-Headers", "x-requested-with")
+        self.set_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
+
+    @tornado.gen.coroutine
+    def get(self):
+        """This function returns devices changed since the given version token; with timeout it waits up to that many seconds for a change"""
+        try:
+            since = change_log.parse_token(self.get_argument('since', ''))
+            timeout = min(float(self.get_argument('timeout', 0)), self.max_wait)
+        except ValueError:
+            raise APIError(status_code=400, log_message="Invalid 'since' or 'timeout' argument")
+        changed = change_log.since(since)
+        if changed is not None and len(changed) == 0 and timeout > 0:
+            yield change_log.wait(timeout)
+            changed = change_log.since(since)
+        if changed is None:
+            # Changes are no longer available or the token is from a previous run,
+            # the client has to reload /rest/all and continue from this version
+            result = {'version': change_log.token(), 'resync': True}
+        else:
+            result = {'version': change_log.token(), 'resync': False, 'devices': map(lambda dev: dev.full(), changed)}
+        self.set_header('Content-Type', 'application/json')
+        self.write(codec.dumps(result))
+        self.finish()
+
+    def options(self):
+        # no body
+        self.set_status(204)
+        self.finish()
+
+class JSONBulkHandler(InvalidateOnPost, APIHandler):
     def initialize(self):
         #enable_cors(self)
         self.set_header("Content-Type", "application/json")
@@ -1627,148 +1850,87 @@ class JSONBulkHandler(APIHandler):
         @tornado.gen.coroutine
         def post(self):
             """This function returns a heterogeneous list of all devices exposed via the REST API"""
-            result = {}
-            js_dict = json.loads(self.request.body)
-            for single_query in js_dict['group_queries']:
-                all_devs = []
-                for device_type in single_query['device_types']:
-                    all_devs += Devices.by_name(device_type)
-                if 'group' in single_query:
-                    all_devs_filtered = []
-                    for single_dev in all_devs:
-                        if hasattr(single_dev, 'arm') and single_dev.arm.major_group == single_query['group']:
-                            all_devs_filtered += single_dev
-                    all_devs = all_devs_filtered
-                if 'device_circuits' in single_query:
-                    all_devs_filtered = []
-                    for single_dev in all_devs:
-                        if single_dev.circuit in single_query['device_circuits']:
-                            all_devs_filtered += single_dev
-                    all_devs = all_devs_filtered
-                if 'global_device_id' in single_query:
-                    all_devs_filtered = []
-                    for single_dev in all_devs:
-                        if single_dev.dev_id == single_query['global_device_id']:
-                            all_devs_filtered += single_dev
-                    all_devs = all_devs_filtered
-                if 'group_queries' in result:
-                    result['group_queries'] += [map(methodcaller('full'), all_devs)]
-                else:
-                    result['group_queries'] = [map(methodcaller('full'), all_devs)]
-            for single_command in js_dict['group_assignments']:
-                all_devs = Devices.by_name(single_command['device_type'])
-                if 'group' in single_command:
-                    all_devs_filtered = []
-                    for single_dev in all_devs:
-                        if single_dev.arm.major_group == single_command['group']:
-                            all_devs_filtered += single_dev
-                    all_devs = all_devs_filtered
-                if 'device_circuits' in single_command:
-                    all_devs_filtered = []
-                    for single_dev in all_devs:
-                        if single_dev.circuit in single_command['device_circuits']:
-                            all_devs_filtered += single_dev
-                    all_devs = all_devs_filtered
-                if 'global_device_id' in single_command:
-                    all_devs_filtered = []
-                    for single_dev in all_devs:
-                        if single_dev.dev_id == single_command['global_device_id']:
-                            all_devs_filtered += single_dev
-                    all_devs = all_devs_filtered
-                for i in range(len(all_devs)):
-                    outp = all_devs[i].set(**(single_command['assigned_values']))
-                    if is_future(outp):
-                        yield outp
-                if 'group_assignments' in result:
-                    result['group_assignments'] += [map(methodcaller('full'), all_devs)]
-                else:
-                    result['group_assignments'] = [map(methodcaller('full'), all_devs)]
-            for single_command in js_dict['individual_assignments']:
-                outp = Devices.by_name(single_command['device_type'], circuit=single_command['device_circuit'])
-                outp = outp.set(**(single_command['assigned_values']))
-                if is_future(outp):
-                    outp = yield outp
-                if 'individual_assignments' in result:
-                    result['individual_assignments'] += [outp]
-                else:
-                    result['individual_assignments'] = [outp]
+            result = yield bulk_request(codec.loads(self.request.body))
             raise gen.Return(result)
     else:
         @schema.validate()
         @tornado.gen.coroutine
         def post(self):
             """This function returns a heterogeneous list of all devices exposed via the REST API"""
-            result = {}
-            js_dict = json.loads(self.request.body)
-            if 'group_queries' in js_dict:
-                for single_query in js_dict['group_queries']:
-                    all_devs = []
-                    for device_type in single_query['device_types']:
-                        all_devs += Devices.by_name(device_type)
-                    if 'group' in single_query:
-                        all_devs_filtered = []
-                        for single_dev in all_devs:
-                            if single_dev.arm.major_group == single_query['group']:
-                                all_devs_filtered += single_dev
-                        all_devs = all_devs_filtered
-                    if 'device_circuits' in single_query:
-                        all_devs_filtered = []
-                        for single_dev in all_devs:
-                            if single_dev.circuit in single_query['device_circuits']:
-                                all_devs_filtered += single_dev
-                        all_devs = all_devs_filtered
-                    if 'global_device_id' in single_query:
-                        all_devs_filtered = []
-                        for single_dev in all_devs:
-                            if single_dev.dev_id == single_query['global_device_id']:
-                                all_devs_filtered += single_dev
-                        all_devs = all_devs_filtered
-                    if 'group_queries' in result:
-                        result['group_queries'] += [map(methodcaller('full'), all_devs)]
-                    else:
-                        result['group_queries'] = [map(methodcaller('full'), all_devs)]
-            if 'group_assignments' in js_dict:
-                for single_command in js_dict['group_assignments']:
-                    all_devs = Devices.by_name(single_command['device_type'])
-                    if 'group' in single_command:
-                        all_devs_filtered = []
-                        for single_dev in all_devs:
-                            if single_dev.arm.major_group == single_command['group']:
-                                all_devs_filtered += single_dev
-                        all_devs = all_devs_filtered
-                    if 'device_circuits' in single_command:
-                        all_devs_filtered = []
-                        for single_dev in all_devs:
-                            if single_dev.circuit in single_command['device_circuits']:
-                                all_devs_filtered += single_dev
-                        all_devs = all_devs_filtered
-                    if 'global_device_id' in single_command:
-                        all_devs_filtered = []
-                        for single_dev in all_devs:
-                            if single_dev.dev_id == single_command['global_device_id']:
-                                all_devs_filtered += single_dev
-                        all_devs = all_devs_filtered
-                    for i in range(len(all_devs)):
-                        outp = all_devs[i].set(**(single_command['assigned_values']))
-                        if is_future(outp):
-                            yield outp
-                    if 'group_assignments' in result:
-                        result['group_assignments'] += [map(methodcaller('full'), all_devs)]
-                    else:
-                        result['group_assignments'] = [map(methodcaller('full'), all_devs)]
-            if     'individual_assignments' in js_dict:
-                for single_command in js_dict['individual_assignments']:
-                    outp = Devices.by_name(single_command['device_type'], circuit=single_command['device_circuit'])
-                    outp = outp.set(**(single_command['assigned_values']))
-                    if is_future(outp):
-                        outp = yield outp
-                    if 'individual_assignments' in result:
-                        result['individual_assignments'] += [outp]
-                    else:
-                        result['individual_assignments'] = [outp]
+            result = yield bulk_request(codec.loads(self.request.body))
             raise gen.Return(result)
 
 
+def bulk_lane(device):
+    """ Devices sharing a Modbus client (i.e. one bus) are set in request order, different lanes run concurrently """
+    arm = getattr(device, 'arm', None)
+    neuron = getattr(arm, 'neuron', None)
+    return getattr(neuron, 'client', neuron)
+
+
+@gen.coroutine
+def bulk_set(assignments):
+    """ Calls set() for a list of (device, assigned_values) and returns the results in the same order """
+    results = [None] * len(assignments)
+    lanes = OrderedDict()
+    for index in range(len(assignments)):
+        lanes.setdefault(bulk_lane(assignments[index][0]), []).append(index)
+
+    @gen.coroutine
+    def run_lane(lane):
+        for index in lane:
+            (device, assigned_values) = assignments[index]
+            outp = device.set(**assigned_values)
+            if is_future(outp):
+                outp = yield outp
+            results[index] = outp
+
+    yield [run_lane(lane) for lane in lanes.values()]
+    raise gen.Return(results)
+
+
+@gen.coroutine
+def bulk_request(js_dict):
+    """ Processes one /bulk request; all assignments are dispatched together through bulk_set() """
+    result = {}
+    if 'group_queries' in js_dict:
+        for single_query in js_dict['group_queries']:
+            all_devs = []
+            for device_type in single_query['device_types']:
+                all_devs += Devices.query(device_type, major_group=single_query.get('group'), circuits=single_query.get('device_circuits'),
+                                          dev_id=single_query.get('global_device_id'))
+            if 'group_queries' in result:
+                result['group_queries'] += [map(methodcaller('full'), all_devs)]
+            else:
+                result['group_queries'] = [map(methodcaller('full'), all_devs)]
+    assignments = []
+    group_devs = []
+    if 'group_assignments' in js_dict:
+        for single_command in js_dict['group_assignments']:
+            all_devs = Devices.query(single_command['device_type'], major_group=single_command.get('group'),
+                                     circuits=single_command.get('device_circuits'), dev_id=single_command.get('global_device_id'))
+            group_devs += [(len(assignments), all_devs)]
+            assignments += [(single_dev, single_command['assigned_values']) for single_dev in all_devs]
+    individual_start = len(assignments)
+    if 'individual_assignments' in js_dict:
+        for single_command in js_dict['individual_assignments']:
+            single_dev = Devices.by_name(single_command['device_type'], circuit=single_command['device_circuit'])
+            assignments += [(single_dev, single_command['assigned_values'])]
+    outputs = yield bulk_set(assignments)
+    if len(group_devs) > 0:
+        result['group_assignments'] = []
+        for (start, all_devs) in group_devs:
+            group_result = []
+            for index in range(len(all_devs)):
+                outp = outputs[start + index]
+                # set() mostly returns full() already, reuse it instead of building it again
+                group_result += [outp if isinstance(outp, dict) and 'dev' in outp else all_devs[index].full()]
+            result['group_assignments'] += [group_result]
+    if len(outputs) > individual_start:
+        result['individual_assignments'] = outputs[individual_start:]
+    raise gen.Return(result)
+
+
 class UniPiQueryService(soaphandler.SoapHandler):
     """ Service which returns a list of values and keys for a given device id and type """
     @tornado.gen.coroutine
@@ -1790,7 +1952,7 @@ class UniPiQueryService(soaphandler.SoapHandler):
                     for single_key in result_keys:
                         prop = SoapProperty()
                         prop.property_name = single_key
-                        prop.property_value = json.dumps(result[single_key])
+                        prop.property_value = codec.dumps(result[single_key])
                         result_properties.property_item += [prop]
                     results += [result_properties]
                 except KeyError:
@@ -1819,7 +1981,7 @@ class UniPiCommandService(soaphandler.SoapHandler):
                 result_properties.property_list = []
                 values_to_set = {}
                 for single_value in single_command.property_item:
-                    values_to_set[single_value.property_name] = json.loads(single_value.property_value)
+                    values_to_set[single_value.property_name] = codec.loads(single_value.property_value)
                 try:
                     outp = Devices.by_name(single_command.device_type, circuit=single_command.device_circuit)
                     outp = outp.set(**values_to_set)
@@ -1829,7 +1991,7 @@ class UniPiCommandService(soaphandler.SoapHandler):
                     for single_key in result_keys:
                         prop = SoapProperty()
                         prop.property_name = single_key
-                        prop.property_value = json.dumps(outp[single_key])
+                        prop.property_value = codec.dumps(outp[single_key])
                         result_properties.property_list += [prop]
                     results += [result_properties]
                 except Exception, E:
@@ -1844,35 +2006,92 @@ class UniPiCommandService(soaphandler.SoapHandler):
 
 
 # callback generators for devents
+def fan_out_status(event):
+    """ Hands one status event to the device snapshots and all websocket and webhook consumers """
+    rest_all_snapshot.on_event(event)
+    json_all_snapshot.on_event(event)
+    change_log.on_event(event)
+    if registered_ws.has_key("all"):
+        for consumer in list(registered_ws['all']):
+            consumer.on_event(event)
+
+
 def gener_status_cb(mainloop, modbus_context):
-    def status_cb_modbus(device, *kwargs):
-        modbus_context.status_callback(device)
-        if registered_ws.has_key("all"):
-            map(lambda x: x.on_event(device), registered_ws['all'])
-        pass
+    def publish_modbus(device):
+        event = devents.StatusEvent(device)
+        for single_dev in event.devices:
+            modbus_context.status_callback(single_dev)
+        fan_out_status(event)
 
-    def status_cb(device, *kwargs):
-        if registered_ws.has_key("all"):
-            map(lambda x: x.on_event(device), registered_ws['all'])
-        pass
+    def publish(device):
+        fan_out_status(devents.StatusEvent(device))
 
     if modbus_context:
-        return status_cb_modbus
+        publish = publish_modbus
+    deadbands = deadband.DeadbandFilter(Config, publish)
+
+    def status_cb(device, *kwargs):
+        if not deadbands.enabled:
+            publish(device)
+            return
+        devices = devents.StatusEvent(device).devices
+        passed = deadbands.filter(devices)
+        if len(passed) == len(devices):
+            publish(device)
+        elif len(passed) == 1:
+            publish(passed[0])
+        elif len(passed) > 1:
+            publish(neuron.Proxy(passed))
+
     return status_cb
 
 
 def gener_config_cb(mainloop, modbus_context):
     def config_cb_modbus(device, *kwargs):
         modbus_context.config_callback(device)
+        config_cb(device)
 
     def config_cb(device, *kwargs):
-        pass
+        event = devents.StatusEvent(device)
+        rest_all_snapshot.on_event(event)
+        json_all_snapshot.on_event(event)
+        change_log.on_event(event)
 
     if modbus_context:
         return config_cb_modbus
     return config_cb
 
 
+def webhook_delivery(section, prefix=""):
+    """ Delivery settings of a webhook section, defaulting to the webhook_* settings of [MAIN] """
+    return {'max_queue': Config.getintdef(section, prefix + "max_queue", Config.getintdef("MAIN", "webhook_max_queue", 1000)),
+            'batch_size': Config.getintdef(section, prefix + "batch_size", Config.getintdef("MAIN", "webhook_batch_size", 32)),
+            'linger_ms': Config.getintdef(section, prefix + "linger_ms", Config.getintdef("MAIN", "webhook_linger_ms", 0)),
+            'max_concurrent': Config.getintdef(section, prefix + "max_concurrent", Config.getintdef("MAIN", "webhook_max_concurrent", 1)),
+            'max_retries': Config.getintdef(section, prefix + "max_retries", Config.getintdef("MAIN", "webhook_max_retries", 3)),
+            'retry_delay': Config.getfloatdef(section, prefix + "retry_delay", Config.getfloatdef("MAIN", "webhook_retry_delay", 0.5))}
+
+
+def webhook_target(section):
+    """ Creates the WhHandler of a [WEBHOOK_<name>] section
+          address, device_mask (JSON list of device types), circuits ({"type": ["circuit", ...]}),
+          aliases (JSON list), fields (JSON list), complex_events and the delivery settings of webhook_delivery()
+    """
+    devtypes = [Devices.type_id(str(devtype)) for devtype in codec.loads(Config.getstringdef(section, "device_mask", '[]'))]
+    circuits = []
+    for (devtype, circuit_list) in codec.loads(Config.getstringdef(section, "circuits", '{}')).items():
+        circuits += [(Devices.type_id(str(devtype)), str(circuit)) for circuit in circuit_list]
+    aliases = [str(alias) for alias in codec.loads(Config.getstringdef(section, "aliases", '[]'))]
+    fields = Config.getstringdef(section, "fields", None)
+    if fields is not None:
+        fields = [str(field) for field in codec.loads(fields)]
+    if len(devtypes) + len(circuits) + len(aliases) == 0:
+        raise Exception("No device_mask, circuits or aliases given")
+    subscription = devents.Subscription(devtypes, circuits, (), aliases, fields)
+    return WhHandler(Config.get(section, "address"), None, Config.getbooldef(section, "complex_events", True),
+                     subscription=subscription, **webhook_delivery(section))
+
+
 ################################ MAIN ################################
 
 def main():
@@ -1917,6 +2136,7 @@ def main():
     app_routes = [
         (r"/rpc/?", rpc_handler.Handler),
         (r"/rest/all/?", RestLoadAllHandler),
+        (r"/rest/changes/?", RestChangesHandler),
         (r"/rest/([^/]+)/([^/]+)/?([^/]+)?/?", LegacyRestHandler),
         (r"/bulk/?", JSONBulkHandler),
         (r"/json/all/?", JSONLoadAllHandler),
@@ -1945,6 +2165,8 @@ def main():
         (r"/json/unit_register/?([^/]+)/?([^/]+)?/?", RestUnitRegisterHandler),
         (r"/json/ext_config/?([^/]+)/?([^/]+)?/?", RestExtConfigHandler),
         (r"/version/?", VersionHandler),
+        (r"/ws/stats/?", WsStatsHandler),
+        (r"/wh/stats/?", WhStatsHandler),
         (r"/ws/?", WsHandler)
     ]
 
@@ -1993,11 +2215,20 @@ def main():
 
 
     if Config.getbooldef("MAIN", "webhook_enabled", False):
-        wh_types = json.loads(Config.getstringdef("MAIN", "webhook_device_mask", '["input", "sensor", "uart", "watchdog"]'))
+        wh_types = codec.loads(Config.getstringdef("MAIN", "webhook_device_mask", '["input", "sensor", "uart", "watchdog"]'))
         wh_complex = Config.getbooldef("MAIN", "webhook_complex_events", False)
-        wh = WhHandler(Config.getstringdef("MAIN", "webhook_address", "http://127.0.0.1:80/index.html"), wh_types, wh_complex)
+        wh = WhHandler(Config.getstringdef("MAIN", "webhook_address", "http://127.0.0.1:80/index.html"), wh_types, wh_complex,
+                       **webhook_delivery("MAIN", "webhook_"))
         wh.open()
 
+    # Additional webhook targets, each in its own [WEBHOOK_<name>] section
+    for section in Config.sections():
+        if section.startswith("WEBHOOK_") and Config.getbooldef(section, "enabled", True):
+            try:
+                webhook_target(section).open()
+            except Exception, E:
+                logger.exception("Error in config section %s - %s", section, str(E))
+
 
     mainLoop = tornado.ioloop.IOLoop.instance()
 
@@ -50,13 +50,14 @@ from pymodbus.register_write_message import *
 
 from pymodbus.pdu import ModbusResponse
 from pymodbus.compat import byte2int
+from pymodbus.utilities import computeCRC
 from tornado.concurrent import Future
 
 import socket
 from tornado import gen
 import tornado.ioloop
 from functools import partial
-from tornado.locks import Semaphore
+from tornado.locks import Semaphore, Condition
 
 import serial
 
@@ -67,6 +68,8 @@ import logging
 _logger = logging.getLogger(__name__)
 
 client_dict = {}
+bus_dict = {}
+UART_IDLE_SCAN_INTERVAL = 0.5       # [s] scan period of slaves without running scanning (no websocket client)
 messages = 0
 
 class AsyncErrorResponse(ModbusResponse):
@@ -80,48 +83,77 @@ class AsyncErrorResponse(ModbusResponse):
         self.error_code = error_code
 
 class AsyncModbusRtuFramer(ModbusRtuFramer):
+    """ Incremental RTU response parser
+          Received bytes are collected in a bytearray; a response is complete as soon as a frame of the length
+          given by its function code (or its byte count) arrives with a valid CRC. Bytes not starting such
+          a frame from the addressed unit (line noise, a late reply of a slave that timed out) are skipped.
+    """
+    FIXED_LENGTHS = {5: 8, 6: 8, 15: 8, 16: 8}      # write responses echo address and value/count
+    BYTE_COUNT_CODES = (1, 2, 3, 4, 23)              # read responses: unit, code, byte count, data, crc
+
     def __init__(self, decoder):
-        #_logger.info("AsyncModbusRtuFramer.__init__()")
         super(AsyncModbusRtuFramer, self).__init__(decoder)
-        self.__buffer = b'' # we can't access ModbusRtuFramer.__buffer
-        self.__buflen = 0
+        self.buffer = bytearray()
+        self.expected_code = None
+        self.expected_unit = None
+    def expect(self, request):
+        self.expected_code = request.function_code
+        self.expected_unit = request.unit_id
     def addToFrame(self, message):
-        ModbusRtuFramer.addToFrame(self, message)
-        self.__buffer += message
-        self.__buflen = self.__buflen + len(message)
+        self.buffer += bytearray(message)
     def resetFrame(self):
         ModbusRtuFramer.resetFrame(self)
-        self.__buffer = b''
-        self.__buflen = 0
-    def isFrameReady(self):
-        #_logger.info("AsyncModbusRtuFramer.isFrameReady()")
-        #if self.decoder:
-            #_logger.info("self.decoder: %s", str(self.decoder))
-        ret = ModbusRtuFramer.isFrameReady(self)
-        #if ret:
-            #_logger.info("FRAME IS READY")
-        return ret
+        self.buffer = bytearray()
     def getFrameLen(self):
-        return self.__buflen
+        return len(self.buffer)
     def isExceptionFrame(self):
-        if self.__buflen == 5 and byte2int(self.__buffer[1]) > 0x80:
-            return True
-        return False
+        return len(self.buffer) == 5 and self.buffer[1] > 0x80
+    def frameLength(self):
+        """ Returns the length of the frame at the start of the buffer, 0 if more bytes are needed to tell
+              and None for function codes of unknown length
+        """
+        if len(self.buffer) < 2:
+            return 0
+        code = self.buffer[1]
+        if code & 0x80:
+            return 5
+        if code in self.FIXED_LENGTHS:
+            return self.FIXED_LENGTHS[code]
+        if code in self.BYTE_COUNT_CODES:
+            if len(self.buffer) < 3:
+                return 0
+            return 5 + self.buffer[2]
+        return None
+    def checkFrameCRC(self, length):
+        frame = self.buffer[:length]
+        return computeCRC(bytes(frame[:-2])) == ((frame[-2] << 8) | frame[-1])
     def processIncomingPacket(self, data, callback):
-        #_logger.info("AsyncModbusRtuFramer.processIncomingPacket(%s)", ":".join("{:02x}".format(ord(c)) for c in data))
-        #_logger.info("  FRAME READY? " + str(self.isFrameReady()))
-        while self.isFrameReady():
-            #_logger.info("  FRAME CHECK? " + str(self.checkFrame()))
-            if self.checkFrame():
-                result = self.decoder.decode(self.getFrame())
-                if result is None:
-                    raise ModbusIOException("Unable to decode response")
-                self.populateResult(result)
-                self.advanceFrame()
-                self.resetFrame()
-                callback(result)  # defer or push to a thread?
+        while len(self.buffer) >= 4:
+            code = self.buffer[1]
+            if self.expected_code is not None and (code & 0x7f) != self.expected_code:
+                del self.buffer[0]
+                continue
+            if self.expected_unit is not None and self.buffer[0] != self.expected_unit:
+                del self.buffer[0]
+                continue
+            length = self.frameLength()
+            if length == 0 or (length is not None and len(self.buffer) < length):
                 return
-            else: return #self.resetFrame() # clear possible errors
+            if length is None:
+                # Unknown function code, the first length with a matching CRC ends the frame
+                length = next((end for end in range(4, len(self.buffer) + 1) if self.checkFrameCRC(end)), None)
+                if length is None:
+                    return
+            elif not self.checkFrameCRC(length):
+                del self.buffer[0]
+                continue
+            result = self.decoder.decode(bytes(self.buffer[1:length - 2]))
+            if result is None:
+                raise ModbusIOException("Unable to decode response")
+            result.unit_id = self.buffer[0]
+            self.resetFrame()
+            callback(result)  # defer or push to a thread?
+            return
     def processError(self, error, callback):
         #_logger.info("AsyncModbusRtuFramer.processError(%s)", str(error))
         self.resetFrame()
@@ -134,10 +166,7 @@ class AsyncFifoTransactionManager(FifoTransactionManager):
         self.request = request
         self.request.transaction_id = self.getNextTID()
         self.frame = self.client.framer.buildPacket(self.request)
-        try:
-            self.recvsize = self.client.framer.getResponseSize(self.request)
-        except (NotImplementedException, AttributeError):
-            self.recvsize = 0;
+        self.client.framer.expect(self.request)
         time_since_last_read = time.time() - self.client._last_frame_end
         #_logger.info(" time_since_last_read: %f, _silent_interval: %f", time_since_last_read, self.client._silent_interval)
         if time_since_last_read < self.client._silent_interval:
@@ -198,9 +227,15 @@ class AsyncModbusSerialClient(ModbusSerialClient):
         self.baudrate = kwargs.get('baudrate', Defaults.Baudrate)
         self.timeout = kwargs.get('timeout',  Defaults.Timeout) or Defaults.Timeout
         self._last_frame_end = 0.0
-        self._silent_interval = 3.5 * (1 + 8 + 2) / self.baudrate
+        self._silent_interval = self.silentInterval()
         self.ioloop = tornado.ioloop.IOLoop.instance()
         self.timer = None
+    def silentInterval(self):
+        """ 3.5 character times of the line settings, fixed 1.75 ms above 19200 Bd as the Modbus RTU spec recommends """
+        if self.baudrate > 19200:
+            return 0.00175
+        char_bits = 1 + self.bytesize + (0 if self.parity == 'N' else 1) + self.stopbits
+        return 3.5 * char_bits / float(self.baudrate)
     @staticmethod
     def __implementation(method):
         method = method.lower()
@@ -233,16 +268,7 @@ class AsyncModbusSerialClient(ModbusSerialClient):
             self.framer.processError(AsyncErrorResponse.SerialReadError,  self._handleResponse)
             return
         #_logger.debug("DATA: %s", str(data))
-        #print "RECVSIZE: %d" % self.transaction.recvsize
         self.framer.addToFrame(data)
-        if self.framer.isExceptionFrame():
-            self.framer.processIncomingPacket(data, self._handleResponse)
-            return
-        #print "RECVSIZE: %d" % self.transaction.recvsize
-        if self.transaction.recvsize:
-            if self.framer.getFrameLen() < self.transaction.recvsize:
-                _logger.debug("  not enough data yet")
-                return
         self.framer.processIncomingPacket(data, self._handleResponse)
     def _handleResponse(self, reply):
         #_logger.info("AsyncModbusSerialClient._handleResponse(%s)", str(reply))
@@ -326,6 +352,19 @@ class AsyncModbusGeneratorClient(AsyncModbusSerialClient):
             self.sem.release()
         raise gen.Return(fut_result.result())
 
+    @gen.coroutine
+    def write_coils(self, address, values, **kwargs):
+        fut_result = Future()
+        request = WriteMultipleCoilsRequest(address, values, **kwargs)
+        yield self.sem.acquire()
+        try:
+            res = self.execute(request)
+            res.addCallback(fut_result.set_result)
+            yield fut_result
+        finally:
+            self.sem.release()
+        raise gen.Return(fut_result.result())
+
     @gen.coroutine
     def write_register(self, address, value, **kwargs):
         fut_result = Future()
@@ -353,24 +392,72 @@ class AsyncModbusGeneratorClient(AsyncModbusSerialClient):
         raise gen.Return(fut_result.result())
 
     
-@gen.coroutine
-def UartStartClient(client, callback=None, callback_args=None):
-    ''' Connect to tcp host and, join to client.transport, wait for reply data
-        Reconnect on close
-    ''' 
-    _logger.info("UART client started") #+ str(callback)
-    while True:
-        if callback:
-            if callback_args is not None:
-                yield callback(callback_args)
-            else:
-                yield callback()
+class UartBus(object):
+    """ Owns one serial port and scans all slaves (UartNeurons) on it from a single loop
+          Every slave has a deadline of its next scan; the most overdue slave is scanned first and slaves due
+          at the same time take turns, so the line does not sit idle while a scan is due. Writes and other
+          requests of the slaves interleave with the scans through the semaphore of the shared client.
+    """
+    def __init__(self, port):
+        self.port = port
+        self.members = []                   # [deadline, turn, neuron], ordered by deadline then turn
+        self.starting = []                  # (neuron, callback, callback_args) run before the first scan
+        self.wakeup = Condition()
+        self.running = False
+        self.turn = 0
+
+    def add(self, neuron, callback=None, callback_args=None):
+        self.starting.append((neuron, callback, callback_args))
+        if not self.running:
+            self.running = True
+            tornado.ioloop.IOLoop.current().add_callback(self.run)
+        else:
+            self.wakeup.notify()
+
+    def wake(self, neuron):
+        """ Makes the slave due now, e.g. after its scanning was started """
+        for member in self.members:
+            if member[2] is neuron:
+                member[0] = min(member[0], time.time())
+        self.wakeup.notify()
+
+    def period(self, neuron):
+        if neuron.do_scanning and neuron.scan_interval > 0:
+            return neuron.scan_interval
+        return max(neuron.scan_interval, UART_IDLE_SCAN_INTERVAL)
+
+    @gen.coroutine
+    def run(self):
+        _logger.info("UART bus %s started", self.port)
         while True:
+            while len(self.starting) > 0:
+                (neuron, callback, callback_args) = self.starting.pop(0)
+                try:
+                    if callback:
+                        if callback_args is not None:
+                            yield callback(callback_args)
+                        else:
+                            yield callback()
+                except Exception, E:
+                    _logger.exception(str(E))
+                self.turn += 1
+                self.members.append([time.time(), self.turn, neuron])
+            if len(self.members) == 0:
+                yield self.wakeup.wait()
+                continue
+            member = min(self.members)
+            delay = member[0] - time.time()
+            if delay > 0:
+                yield self.wakeup.wait(timeout=datetime.timedelta(seconds=delay))
+                continue
             try:
-                yield gen.sleep(0.5)
-                yield client.scan_boards(invoc=True)
+                yield member[2].scan_once()
             except Exception, E:
                 _logger.exception(str(E))
+            # A slave that could not keep its period goes behind the other due slaves
+            self.turn += 1
+            member[0] = max(member[0] + self.period(member[2]), time.time())
+            member[1] = self.turn
 
 '''
     client = ModbusClientProtocol()
@@ -10,6 +10,9 @@ from pymodbus.register_read_message import *
 from pymodbus.register_write_message import *
 
 
+import datetime
+import random
+import time
 from tornado import gen
 from tornado.concurrent import TracebackFuture
 from tornado.iostream import StreamClosedError
@@ -21,7 +24,55 @@ from tornado.tcpclient import TCPClient
 from log import *
 
 
-class ModbusClientProtocol():
+class ModbusRequestMixin(object):
+    '''
+    Request methods of a Modbus client, built on its execute(request)
+    '''
+
+    @gen.coroutine
+    def read_input_registers(self, address, count=1, **kwargs):
+        request = ReadInputRegistersRequest(address, count, **kwargs)
+        res = yield self.execute(request)
+        raise gen.Return(res)
+    
+    @gen.coroutine
+    def read_holding_registers(self, address, count=1, **kwargs):
+        request = ReadHoldingRegistersRequest(address, count, **kwargs)
+        res = yield self.execute(request)
+        raise gen.Return(res)
+
+    @gen.coroutine
+    def write_coil(self, address, value, **kwargs):
+        request = WriteSingleCoilRequest(address, value, **kwargs)
+        res = yield self.execute(request)
+        raise gen.Return(res)
+
+    @gen.coroutine
+    def write_coils(self, address, values, **kwargs):
+        request = WriteMultipleCoilsRequest(address, values, **kwargs)
+        res = yield self.execute(request)
+        raise gen.Return(res)
+
+    @gen.coroutine
+    def read_coils(self, address, count=1, **kwargs):
+        request = ReadCoilsRequest(address, count=1, **kwargs)
+        res = yield self.execute(request)
+        raise gen.Return(res)
+
+    @gen.coroutine
+    def write_register(self, address, value, **kwargs):
+        request = WriteSingleRegisterRequest(address, value, **kwargs)
+        res = yield self.execute(request)
+        raise gen.Return(res)
+
+    @gen.coroutine
+    def write_registers(self, address, values, **kwargs):
+        request = WriteMultipleRegistersRequest(address, values, **kwargs)
+        res = yield self.execute(request)
+        raise gen.Return(res)
+
+
+class ModbusClientProtocol(ModbusRequestMixin):
     '''
     This represents the base modbus client protocol.  All the application
     layer code is deferred to a higher level wrapper.
@@ -33,6 +84,7 @@ class ModbusClientProtocol():
         :param framer: The framer to use for the protocol
         '''
         self.connected = False
+        self.transport = None
         self.framer = framer or ModbusSocketFramer(ClientDecoder())
         if isinstance(self.framer, ModbusSocketFramer):
             self.transaction = DictTransactionManager(self)
@@ -43,7 +95,7 @@ class ModbusClientProtocol():
         # clear frame buffer
         self.framer.advanceFrame()
         # clear all transaction with exception
-        for tid in self.transaction:
+        for tid in list(self.transaction):
             future = self.transaction.getTransaction(tid)
             future.set_exception(ConnectionException("Slave closed"))
         self.transport = stream
@@ -82,74 +134,198 @@ class ModbusClientProtocol():
         packet = self.framer.buildPacket(request)
         if not self.transport:
             raise ConnectionException("Slave not connected")
-        yield self.transport.write(packet)
+        # register the transaction before writing - with pipelined requests the reply
+        # may be processed before the write future resolves
         future = TracebackFuture()
         self.transaction.addTransaction(future, request.transaction_id)
+        try:
+            yield self.transport.write(packet)
+        except Exception:
+            self.transaction.delTransaction(request.transaction_id)
+            raise
         res = yield future
         raise gen.Return(res)
 
 
-    @gen.coroutine
-    def read_input_registers(self, address, count=1, **kwargs):
-        request = ReadInputRegistersRequest(address, count, **kwargs)
-        res = yield self.execute(request)
-        raise gen.Return(res)
-    
-    @gen.coroutine
-    def read_holding_registers(self, address, count=1, **kwargs):
-        request = ReadHoldingRegistersRequest(address, count, **kwargs)
-        res = yield self.execute(request)
-        raise gen.Return(res)
-
-    @gen.coroutine
-    def write_coil(self, address, value, **kwargs):
-        request = WriteSingleCoilRequest(address, value, **kwargs)
-        res = yield self.execute(request)
-        raise gen.Return(res)
-
-    @gen.coroutine
-    def read_coils(self, address, count=1, **kwargs):
-        request = ReadCoilsRequest(address, count=1, **kwargs)
-        res = yield self.execute(request)
-        raise gen.Return(res)
+RECONNECT_MIN = 0.1            # [s] first delay before reconnecting, doubled after every failed attempt
+RECONNECT_MAX = 10.0
+RECONNECT_STABLE = 5.0         # [s] a connection kept at least this long starts the delays from the beginning again
 
-    @gen.coroutine
-    def write_register(self, address, value, **kwargs):
-        request = WriteSingleRegisterRequest(address, value, **kwargs)
-        res = yield self.execute(request)
-        raise gen.Return(res)
 
-    @gen.coroutine
-    def write_registers(self, address, values, **kwargs):
-        request = WriteMultipleRegistersRequest(address, values, **kwargs)
-        res = yield self.execute(request)
-        raise gen.Return(res)
+def reconnect_delay(attempt, minimum, maximum):
+    ''' Exponential back-off with jitter, clients losing the server at the same time do not come back at once '''
+    delay = min(maximum, minimum * (2 ** attempt))
+    return random.uniform(delay / 2, delay)
 
 
 @gen.coroutine
-def StartClient(client, host='127.0.0.1', port=502, callback=None, callback_args=None):
+def StartClient(client, host='127.0.0.1', port=502, callback=None, callback_args=None, resync=None):
     ''' Connect to tcp host and, join to client.transport, wait for reply data
-        Reconnect on close
+        Reconnect on close, waiting reconnect_delay() between attempts
+        callback runs after the first connection, resync (callback if not given) after every reconnection
     ''' 
     logger.info("TCP/Modbus client to {}:{} started".format(host, port))
+    attempt = 0
+    connected_once = False
     while True:
+        stream = None
+        connected_at = None
         try:
             stream = yield TCPClient().connect(host, port)
+            connected_at = time.time()
             client.setTransport(stream)
             future = stream.read_until_close(streaming_callback = client.dataReceived)
-            if callback:
+            handler = resync if (connected_once and resync is not None) else callback
+            connected_once = True
+            if handler:
                 if callback_args is not None:
-                    yield callback(callback_args)
+                    yield handler(callback_args)
                 else:
-                    yield callback()
+                    yield handler()
             yield future
         except StreamClosedError:
             pass
         except Exception, E:
             logger.exception(str(E))
-            stream.close()
+            if stream is not None:
+                stream.close()
         finally:
             client.setTransport(None)
+        if connected_at is not None and time.time() - connected_at >= RECONNECT_STABLE:
+            attempt = 0
+        yield gen.sleep(reconnect_delay(attempt, RECONNECT_MIN, RECONNECT_MAX))
+        attempt += 1
+
+POOL_RECONNECT_MIN = 0.5       # [s] first delay before reconnecting a pool socket, doubled after every failed attempt
+POOL_RECONNECT_MAX = 30.0
+
+pool_dict = {}
+
+
+def get_pool(host, port, sockets=1, request_timeout=5.0):
+    ''' Returns the connection pool of host:port, shared by all devices behind it
+        The pool gets the largest socket count asked for before it is started and the largest request timeout
+    '''
+    key = '%s:%s' % (host, port)
+    if key not in pool_dict:
+        pool_dict[key] = ModbusConnectionPool(host, int(port), sockets, request_timeout)
+    pool = pool_dict[key]
+    pool.sockets = max(pool.sockets, sockets)
+    pool.request_timeout = max(pool.request_timeout, request_timeout)
+    return pool
+
+
+def _retrieve_exception(future):
+    # The request was given up on timeout, its failure on the closed connection is expected
+    future.exception()
+
+
+class ModbusConnectionPool(ModbusRequestMixin):
+    '''
+    Several Modbus/TCP connections (ModbusClientProtocol) to one host:port offering the same request methods.
+    Requests of one unit id always use the same socket while it is connected (replies of a unit keep their
+    order), different units are spread over the sockets. A socket that does not answer a request within
+    request_timeout is closed and reconnected, reconnects back off from POOL_RECONNECT_MIN to POOL_RECONNECT_MAX
+    (see reconnect_delay()).
+    '''
+
+    def __init__(self, host, port, sockets=1, request_timeout=5.0):
+        self.host = host
+        self.port = port
+        self.sockets = max(1, sockets)
+        self.request_timeout = request_timeout
+        self.connections = []
+        self.connected_count = 0
+        self.connect_callbacks = []     # (callback, callback_args, resync) run whenever the pool gets connected
+        self.connected_once = False
+        self.started = False
+        self.timeouts = 0
+
+    @property
+    def connected(self):
+        return self.connected_count > 0
+
+    def add_connect_callback(self, callback, callback_args=None, resync=None):
+        ''' callback runs after the first connection of the pool, resync (callback if not given) after every reconnection '''
+        self.connect_callbacks.append((callback, callback_args, resync))
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        logger.info("TCP/Modbus pool of {} connections to {}:{} started".format(self.sockets, self.host, self.port))
+        for index in range(self.sockets):
+            client = ModbusClientProtocol()
+            self.connections.append(client)
+            self.keep_connected(client)
+
+    @gen.coroutine
+    def run_callback(self, callback, callback_args):
+        try:
+            if callback_args is not None:
+                yield callback(callback_args)
+            else:
+                yield callback()
+        except Exception, E:
+            logger.exception(str(E))
+
+    @gen.coroutine
+    def keep_connected(self, client):
+        attempt = 0
+        while True:
+            stream = None
+            connected_at = None
+            try:
+                stream = yield TCPClient().connect(self.host, self.port)
+                connected_at = time.time()
+                client.setTransport(stream)
+                future = stream.read_until_close(streaming_callback = client.dataReceived)
+                self.connected_count += 1
+                try:
+                    if self.connected_count == 1:
+                        for (callback, callback_args, resync) in self.connect_callbacks:
+                            if self.connected_once and resync is not None:
+                                callback = resync
+                            self.run_callback(callback, callback_args)
+                        self.connected_once = True
+                    yield future
+                finally:
+                    self.connected_count -= 1
+            except StreamClosedError:
+                pass
+            except Exception, E:
+                logger.debug("TCP/Modbus connection to {}:{} failed: {}".format(self.host, self.port, str(E)))
+                if stream is not None:
+                    stream.close()
+            finally:
+                client.setTransport(None)
+            if connected_at is not None and time.time() - connected_at >= RECONNECT_STABLE:
+                attempt = 0
+            yield gen.sleep(reconnect_delay(attempt, POOL_RECONNECT_MIN, POOL_RECONNECT_MAX))
+            attempt += 1
+
+    def pick(self, unit):
+        connected = [client for client in self.connections if client.connected]
+        if len(connected) == 0:
+            raise ConnectionException("Slave not connected")
+        preferred = self.connections[unit % len(self.connections)]
+        if preferred.connected:
+            return preferred
+        return connected[unit % len(connected)]
+
+    @gen.coroutine
+    def execute(self, request):
+        client = self.pick(request.unit_id)
+        future = client.execute(request)
+        try:
+            res = yield gen.with_timeout(datetime.timedelta(seconds=self.request_timeout), future)
+        except gen.TimeoutError:
+            future.add_done_callback(_retrieve_exception)
+            self.timeouts += 1
+            if client.transport is not None:
+                client.transport.close()
+            raise ConnectionException("Request to unit %d timed out" % request.unit_id)
+        raise gen.Return(res)
 
 '''
     client = ModbusClientProtocol()
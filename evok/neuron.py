@@ -4,15 +4,18 @@
 '''
 import struct
 import datetime
+from array import array
 from dali.bus import Bus
 import dali.gear.general
 from math import sqrt
 from tornado import gen
 from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
 from modbusclient_tornado import ModbusClientProtocol, StartClient
+import modbusclient_tornado
 from pymodbus.pdu import ExceptionResponse
 from pymodbus.exceptions import ModbusIOException
-from tornado.locks import Semaphore
+from tornado.locks import Semaphore, Lock
 import modbusclient_rs485
 
 from devices import *
@@ -28,80 +31,263 @@ from dali.address import Broadcast, Group
 class ENoBoard(Exception):
     pass
 
+MAX_READ_REGISTERS = 125    # Modbus PDU limit of a single read_holding/input_registers request
+MAX_WRITE_REGISTERS = 123   # Modbus PDU limit of a single write_registers request
+MAX_WRITE_COILS = 1968      # Modbus PDU limit of a single write_coils request
+ADAPTIVE_STABLE_READS = 8   # unchanged reads of a block after which adaptive scanning halves its poll rate
+QUARANTINE_AFTER_FAILURES = 3   # consecutive failed scans after which a Modbus slave is only probed
+QUARANTINE_MIN_BACKOFF = 1.0    # [s] first probe interval of a quarantined slave, doubled on every failed probe
+QUARANTINE_MAX_BACKOFF = 30.0
+LATENCY_EWMA_WEIGHT = 0.2
+
+
+def plan_register_reads(reg_groups, max_gap=0, max_count=MAX_READ_REGISTERS, no_merge=()):
+    """ Merges register blocks of one type into the fewest read requests
+          Blocks are merged if they are at most max_gap registers apart and the resulting request
+          does not exceed max_count registers. Blocks with start_reg in no_merge are always read alone.
+          Returns a list of (start_reg, count, [block, ...])
+    """
+    plan = []
+    run = None
+    for block in sorted(reg_groups, key=lambda group: group.start_reg):
+        start = block.start_reg
+        end = start + block.count
+        if run is not None and start not in no_merge and run[3] \
+                and start - run[1] <= max_gap and max(end, run[1]) - run[0] <= max_count:
+            run[1] = max(end, run[1])
+            run[2].append(block)
+        else:
+            run = [start, end, [block], start not in no_merge]
+            plan.append(run)
+    return [(run[0], run[1] - run[0], run[2]) for run in plan]
+
+
+def plan_write_runs(writes, max_count, merge=True):
+    """ Groups queued writes {address: [value, future]} into runs of contiguous addresses
+          of at most max_count values; without merge every write is a run of its own.
+          Returns a list of (address, [value, ...], [future, ...])
+    """
+    runs = []
+    for address in sorted(writes):
+        if merge and len(runs) > 0 and address == runs[-1][0] + len(runs[-1][1]) and len(runs[-1][1]) < max_count:
+            runs[-1][1].append(writes[address][0])
+            runs[-1][2].append(writes[address][1])
+        else:
+            runs += [(address, [writes[address][0]], [writes[address][1]])]
+    return runs
+
+
+class RegisterBlock(object):
+    """ One entry of modbus_register_blocks together with the last values read from it """
+    def __init__(self, m_reg_group, adaptive_factor=1):
+        self.start_reg = m_reg_group['start_reg']
+        self.count = m_reg_group['count']
+        self.frequency = m_reg_group['frequency']
+        # Bounds of the read divisor when adaptive scanning is enabled
+        self.min_frequency = m_reg_group.get('min_frequency', max(1, self.frequency // adaptive_factor))
+        self.max_frequency = m_reg_group.get('max_frequency', self.frequency * adaptive_factor)
+        self.stable_reads = 0
+        self.is_input = 'type' in m_reg_group and m_reg_group['type'] == 'input'
+        self.values = array('H', [0] * self.count)
+        self.valid = bytearray(self.count)    # per register flag of a cached value
+        self.complete = False                 # all registers of the block hold a cached value
+        self.watchers = []    # [(offset, [dependent device, ...]), ...] of registers having datadeps
+
+
 class ModbusCacheMap(object):
     last_comm_time = 0
     def __init__(self, modbus_reg_map, neuron):
         self.modbus_reg_map = modbus_reg_map
         self.neuron = neuron
         self.sem = Semaphore(1)
-        self.registered = {}
-        self.registered_input = {}
         self.frequency = {}
+        self.max_read_gap = neuron.Config.getintdef("MAIN", "modbus_read_max_gap", 0)
+        self.no_merge = set()
+        self.adaptive = neuron.Config.getbooldef("MAIN", "adaptive_scan", False)
+        adaptive_factor = max(1, neuron.Config.getintdef("MAIN", "adaptive_scan_factor", 10))
+        self.blocks = []
+        self.registered = {}          # register -> (block, offset)
+        self.registered_input = {}
+        self.watched_deps = -1
         for m_reg_group in modbus_reg_map:
-            self.frequency[m_reg_group['start_reg']] = 10000001    # frequency less than 1/10 million are not read on start
-            for index in range(m_reg_group['count']):
-                if 'type' in m_reg_group and m_reg_group['type'] == 'input':
-                    self.registered_input[(m_reg_group['start_reg'] + index)] = None
-                else:
-                    self.registered[(m_reg_group['start_reg'] + index)] = None
+            block = RegisterBlock(m_reg_group, adaptive_factor)
+            self.blocks += [block]
+            self.frequency[block.start_reg] = 10000001    # frequency less than 1/10 million are not read on start
+            registered = self.registered_input if block.is_input else self.registered
+            for index in range(block.count):
+                registered[block.start_reg + index] = (block, index)
+
+    def refresh(self):
+        """ Makes all blocks due in the next scan, values found changed are reported as usual """
+        for block in self.blocks:
+            self.frequency[block.start_reg] = 0
 
     def get_register(self, count, index, unit=0, is_input=False):
-        ret = []
-        for counter in range(index,count+index):
+        """ Returns cached values of [count] registers starting at [index] as array('H') """
+        registered = self.registered_input if is_input else self.registered
+        try:
+            block, offset = registered[index]
+        except KeyError:
+            raise Exception('Unknown register %d' % index)
+        if block.complete and offset + count <= block.count:
+            return block.values[offset:offset + count]
+        # Registers spanning several blocks or a block which has not been read completely yet
+        ret = array('H')
+        for counter in range(index, count + index):
+            if counter not in registered:
+                raise Exception('Unknown register %d' % counter)
+            block, offset = registered[counter]
+            if not block.valid[offset]:
+                raise Exception('No cached value of register %d on unit %d - read error' % (counter, unit))
+            ret.append(block.values[offset])
+        return ret
+
+    def index_watchers(self):
+        """ Precomputes the registers with dependent devices of every block; datadeps only grow while devices are parsed """
+        for block in self.blocks:
+            block.watchers = []
+            for index in range(block.count):
+                if (block.start_reg + index) in self.neuron.datadeps:
+                    block.watchers += [(index, self.neuron.datadeps[block.start_reg + index])]
+        self.watched_deps = len(self.neuron.datadeps)
+
+    def store_value(self, index, value, is_input=False):
+        """ Updates a single cached register after a direct read or write """
+        if is_input:
+            block, offset = self.registered_input[index]
+        else:
+            block, offset = self.registered[index]
+        block.values[offset] = int(value) & 0xffff
+        if not block.complete:
+            block.valid[offset] = 1
+            block.complete = all(block.valid)
+
+    def update_block(self, block, registers, changeset):
+        """ Stores freshly read values of one register block and collects devices affected by the change
+              Returns False if the block holds the same values as before or was read for the first time
+        """
+        registers = array('H', registers)
+        initial = not block.complete
+        if initial:
+            for (offset, deps) in block.watchers:
+                changeset += deps
+        elif block.values != registers:
+            if block.is_input:
+                delta_types = (Input, ULED)
+            else:
+                delta_types = (Input, ULED, Relay, Watchdog)
+            old = block.values
+            for (offset, deps) in block.watchers:
+                if old[offset] != registers[offset]:
+                    for ddep in deps:
+                        # value_delta() compares against the cached value, so the cache is updated only afterwards
+                        if not isinstance(ddep, delta_types) or ddep.value_delta(registers[offset]):
+                            changeset += [ddep]
+        else:
+            self.frequency[block.start_reg] = 1
+            return False
+        block.values = registers
+        if initial:
+            block.valid = bytearray([1] * block.count)
+            block.complete = True
+        self.frequency[block.start_reg] = 1
+        return not initial
+
+    def adapt_frequency(self, block, changed):
+        """ Reads a changing block twice as often, backs off a block stable for ADAPTIVE_STABLE_READS reads """
+        if changed:
+            block.stable_reads = 0
+            block.frequency = max(block.min_frequency, block.frequency // 2)
+        else:
+            block.stable_reads += 1
+            if block.stable_reads >= ADAPTIVE_STABLE_READS:
+                block.stable_reads = 0
+                block.frequency = min(block.max_frequency, block.frequency * 2)
+
+    def plan_scan(self):
+        """ Returns read requests (is_input, start_reg, count, [block, ...]) for all blocks due in this cycle """
+        due = {True: [], False: []}
+        for block in self.blocks:
+            if (self.frequency[block.start_reg] >= block.frequency) or (self.frequency[block.start_reg] == 0):    # only read once for every [frequency] cycles
+                due[block.is_input].append(block)
+            else:
+                self.frequency[block.start_reg] += 1
+        plan = []
+        for is_input in (False, True):
+            for (start_reg, count, groups) in plan_register_reads(due[is_input], max_gap=self.max_read_gap, no_merge=self.no_merge):
+                plan += [(is_input, start_reg, count, groups)]
+        return plan
+
+    @gen.coroutine
+    def read_run(self, is_input, start_reg, count, unit=0):
+        """ Reads one planned request, returns (response, time of its arrival)
+              errors are returned instead of raised so that pipelined reads can be gathered
+        """
+        try:
             if is_input:
-                if counter not in self.registered_input:
-                    raise Exception('Unknown register %d' % counter)
-                elif self.registered_input[counter] is None:
-                    raise Exception('No cached value of register %d on unit %d - read error' % (counter, unit))
-                ret += [self.registered_input[counter]]
+                val = yield self.neuron.client.read_input_registers(start_reg, count, unit=unit)
             else:
-                if counter not in self.registered:
-                    raise Exception('Unknown register %d' % counter)
-                elif self.registered[counter] is None:
-                    raise Exception('No cached value of register %d on unit %d - read error' % (counter, unit))
-                ret += [self.registered[counter]]
-        return ret
+                val = yield self.neuron.client.read_holding_registers(start_reg, count, unit=unit)
+        except Exception, E:
+            val = E
+        raise gen.Return((val, time.time()))
 
     @gen.coroutine
     def do_scan(self, unit=0, initial=False):
+        """ Reads all due register blocks, returns (answered, failed) requests and the time spent on the answered ones
+              A request without any response ends the scan, the slave is most likely gone
+        """
         if initial:
             yield self.sem.acquire()
+        answered = 0
+        failed = 0
+        answered_time = 0.0
+        abort = False
         changeset = []
-        for m_reg_group in self.modbus_reg_map:
-            if (self.frequency[m_reg_group['start_reg']] >= m_reg_group['frequency']) or (self.frequency[m_reg_group['start_reg']] == 0):    # only read once for every [frequency] cycles
+        if len(self.neuron.datadeps) != self.watched_deps:
+            self.index_watchers()
+        plan = self.plan_scan()
+        window = max(1, self.neuron.pipeline_window)
+        while len(plan) > 0 and not abort:
+            # Up to [window] requests are written back-to-back and awaited together
+            batch = plan[:window]
+            plan = plan[window:]
+            batch_start = time.time()
+            results = yield [self.read_run(is_input, start_reg, count, unit=unit) for (is_input, start_reg, count, groups) in batch]
+            arrivals = sorted(arrival for (val, arrival) in results)
+            for ((is_input, start_reg, count, groups), (val, arrival)) in zip(batch, results):
                 try:
-                    val = None
-                    if 'type' in m_reg_group and m_reg_group['type'] == 'input':
-                        val = yield self.neuron.client.read_input_registers(m_reg_group['start_reg'], m_reg_group['count'], unit=unit)
+                    if isinstance(val, Exception) or isinstance(val, AsyncErrorResponse):
+                        failed += 1
+                        abort = True
                     else:
-                        val = yield self.neuron.client.read_holding_registers(m_reg_group['start_reg'], m_reg_group['count'], unit=unit)
-                    if not isinstance(val, AsyncErrorResponse) and not isinstance(val, ModbusIOException) and not isinstance(val, ExceptionResponse):
+                        answered += 1
+                        # The requests of a batch are served one after another, a response took the time since the previous one
+                        previous = arrivals.index(arrival)
+                        answered_time += arrival - (arrivals[previous - 1] if previous > 0 else batch_start)
+                    if isinstance(val, Exception):
+                        raise val
+                    if not isinstance(val, AsyncErrorResponse) and not isinstance(val, ExceptionResponse):
                         self.last_comm_time = time.time()
-                        if 'type' in m_reg_group and m_reg_group['type'] == 'input':
-                            for index in range(m_reg_group['count']):
-                                if (m_reg_group['start_reg'] + index) in self.neuron.datadeps and self.registered_input[(m_reg_group['start_reg'] + index)] != val.registers[index]:
-                                    for ddep in self.neuron.datadeps[m_reg_group['start_reg'] + index]:
-                                        if (not ((isinstance(ddep, Input) or isinstance(ddep, ULED)))) or ddep.value_delta(val.registers[index]):
-                                            changeset += [ddep]
-                                self.registered_input[(m_reg_group['start_reg'] + index)] = val.registers[index]
-                                self.frequency[m_reg_group['start_reg']] = 1
-                        else:
-                            for index in range(m_reg_group['count']):
-                                if (m_reg_group['start_reg'] + index) in self.neuron.datadeps and self.registered[(m_reg_group['start_reg'] + index)] != val.registers[index]:
-                                    for ddep in self.neuron.datadeps[m_reg_group['start_reg'] + index]:
-                                        if (not ((isinstance(ddep, Input) or isinstance(ddep, ULED) or isinstance(ddep, Relay) or isinstance(ddep, Watchdog)))) or ddep.value_delta(val.registers[index]):
-                                            changeset += [ddep]
-                                self.registered[(m_reg_group['start_reg'] + index)] = val.registers[index]
-                                self.frequency[m_reg_group['start_reg']] = 1
+                        for block in groups:
+                            offset = block.start_reg - start_reg
+                            changed = self.update_block(block, val.registers[offset:offset + block.count], changeset)
+                            if self.adaptive:
+                                self.adapt_frequency(block, changed)
+                    elif isinstance(val, ExceptionResponse) and len(groups) > 1:
+                        # The device refused the merged request (e.g. a gap register does not exist), read these blocks separately from now on
+                        logger.info("Merged read of registers %d-%d on unit %d refused, disabling merging of its blocks" % (start_reg, start_reg + count - 1, unit))
+                        for block in groups:
+                            self.no_merge.add(block.start_reg)
+                            plan += [(is_input, block.start_reg, block.count, [block])]
                 except Exception, E:
                     logger.debug(str(E))
-            else:
-                self.frequency[m_reg_group['start_reg']] += 1
         if len(changeset) > 0:
             proxy = Proxy(set(changeset))
             devents.status(proxy)
         if initial:
             self.sem.release()
+        raise gen.Return((answered, failed, answered_time))
 
     def set_register(self, count, index, inp, unit=0, is_input=False):
         if len(inp) < count:
@@ -111,12 +297,12 @@ class ModbusCacheMap(object):
                 if index + counter not in self.registered_input:
                     raise Exception('Unknown register %d' % index + counter)
                 self.neuron.client.write_register(index + counter, 1, inp[counter], unit=unit)
-                self.registered_input[index + counter] = inp[counter]
+                self.store_value(index + counter, inp[counter], is_input=True)
             else:
                 if index + counter not in self.registered:
                     raise Exception('Unknown register %d' % index + counter)
                 self.neuron.client.write_register(index + counter, 1, inp[counter], unit=unit)
-                self.registered[index + counter] = inp[counter]
+                self.store_value(index + counter, inp[counter])
 
     def has_register(self, index, is_input=False):
         if is_input:
@@ -138,7 +324,7 @@ class ModbusCacheMap(object):
                     raise Exception('Unknown register')
             val = yield self.neuron.client.read_input_registers(index, count, unit=unit)
             for counter in range(len(val.registers)):
-                self.registered_input[index+counter] = val.registers[counter]
+                self.store_value(index + counter, val.registers[counter], is_input=True)
             raise gen.Return(val.registers)
         else:
             for counter in range(index,count+index):
@@ -146,7 +332,7 @@ class ModbusCacheMap(object):
                     raise Exception('Unknown register')
             val = yield self.neuron.client.read_holding_registers(index, count, unit=unit)
             for counter in range(len(val.registers)):
-                self.registered[index+counter] = val.registers[counter]
+                self.store_value(index + counter, val.registers[counter])
             raise gen.Return(val.registers)
 
 
@@ -159,7 +345,7 @@ class ModbusCacheMap(object):
                 if index + counter not in self.registered_input:
                     raise Exception('Unknown register')
                 yield self.neuron.client.write_register(index + counter, 1, inp[counter], unit=unit)
-                self.registered_input[index + counter] = inp[counter]
+                self.store_value(index + counter, inp[counter], is_input=True)
         else:
             if len(inp) < count:
                 raise Exception('Insufficient data to write into registers')
@@ -167,10 +353,91 @@ class ModbusCacheMap(object):
                 if index + counter not in self.registered:
                     raise Exception('Unknown register')
                 yield self.neuron.client.write_register(index + counter, 1, inp[counter], unit=unit)
-                self.registered[index + counter] = inp[counter]
+                self.store_value(index + counter, inp[counter])
+
+class WriteScheduler(object):
+    """ Collects coil and register writes issued within one IOLoop iteration and sends them
+          as write_coils/write_registers requests over contiguous address ranges
+          A unit refusing such a request gets its writes one by one (write_coil/write_register) from then on
+    """
+    def __init__(self, neuron):
+        self.neuron = neuron
+        self.pending = {}    # (unit, is_coil) -> {address: [value, future]}
+        self.no_merge = set()    # (unit, is_coil) of slaves without write_coils/write_registers
+        self.scheduled = False
+        self.lock = Lock()   # flushes run one after another, in the order they were scheduled
+
+    def write_coil(self, address, value, unit=0):
+        return self.add(True, address, value, unit)
+
+    def write_register(self, address, value, unit=0):
+        return self.add(False, address, value, unit)
+
+    def add(self, is_coil, address, value, unit):
+        """ Queues one write; the returned future resolves with the response of the request carrying it """
+        writes = self.pending.setdefault((unit, is_coil), {})
+        if address in writes:
+            writes[address][0] = value    # the last write to an address within one iteration wins
+        else:
+            writes[address] = [value, Future()]
+        if not self.scheduled:
+            self.scheduled = True
+            IOLoop.instance().add_callback(self.flush)
+        return writes[address][1]
+
+    @gen.coroutine
+    def flush(self):
+        pending = self.pending
+        self.pending = {}
+        self.scheduled = False
+        # A flush started while the previous one still waits for its responses must not overtake it,
+        # a newer value written to the same address would be overwritten by the older one
+        with (yield self.lock.acquire()):
+            yield self.write_pending(pending)
+
+    @gen.coroutine
+    def write_pending(self, pending):
+        # Coils go first; Relay.set() switches the coil off before it changes the PWM duty register
+        for (unit, is_coil) in sorted(pending, key=lambda key: (not key[1], key[0])):
+            max_count = MAX_WRITE_COILS if is_coil else MAX_WRITE_REGISTERS
+            runs = plan_write_runs(pending[(unit, is_coil)], max_count, merge=(unit, is_coil) not in self.no_merge)
+            for (address, values, futures) in runs:
+                if len(values) > 1:
+                    try:
+                        if is_coil:
+                            res = yield self.neuron.client.write_coils(address, values, unit=unit)
+                        else:
+                            res = yield self.neuron.client.write_registers(address, values, unit=unit)
+                    except Exception, E:
+                        res = E
+                    if not isinstance(res, (Exception, ExceptionResponse)):
+                        for future in futures:
+                            future.set_result(res)
+                        continue
+                    # The slave refused the merged write (e.g. it knows only function codes 5 and 6), write these one by one from now on
+                    logger.info("Merged write of %d %s at %d on unit %d failed (%s), disabling merging of its writes"
+                                % (len(values), "coils" if is_coil else "registers", address, unit, str(res)))
+                    self.no_merge.add((unit, is_coil))
+                for index in range(len(values)):
+                    yield self.write_single(is_coil, address + index, values[index], futures[index], unit)
+
+    @gen.coroutine
+    def write_single(self, is_coil, address, value, future, unit):
+        try:
+            if is_coil:
+                res = yield self.neuron.client.write_coil(address, value, unit=unit)
+            else:
+                res = yield self.neuron.client.write_register(address, value, unit=unit)
+        except Exception, E:
+            logger.debug("Write of %s %d on unit %d failed: %s" % ("coil" if is_coil else "register", address, unit, str(E)))
+            future.set_exception(E)
+        else:
+            future.set_result(res)
+
 
 class Neuron(object):
-    def __init__(self, circuit, Config, modbus_server, modbus_port, scan_freq, scan_enabled, hw_dict, direct_access=False, major_group=1, dev_id=0):
+    def __init__(self, circuit, Config, modbus_server, modbus_port, scan_freq, scan_enabled, hw_dict, direct_access=False, major_group=1, dev_id=0,
+                 pipeline_window=1):
         self.alias = ""
         self.devtype = NEURON
         self.dev_id = dev_id
@@ -191,6 +458,8 @@ class Neuron(object):
         else:
             self.scan_interval = 1.0 / scan_freq
         self.scan_enabled = scan_enabled
+        self.pipeline_window = pipeline_window
+        self.writer = WriteScheduler(self)
         self.boards = list()
         self.modbus_cache_map = None
         self.versions = []
@@ -199,7 +468,8 @@ class Neuron(object):
     def switch_to_async(self, loop, alias_dict):
         self.loop = loop
         self.client = ModbusClientProtocol()
-        loop.add_callback(lambda: StartClient(self.client, self.modbus_server, self.modbus_port, self.readboards, callback_args=alias_dict))
+        loop.add_callback(lambda: StartClient(self.client, self.modbus_server, self.modbus_port, self.readboards, callback_args=alias_dict,
+                                              resync=self.resync))
 
     @gen.coroutine
     def set(self, print_log=None):
@@ -216,6 +486,7 @@ class Neuron(object):
         for board in self.boards:
             del (board)
         self.boards = list()
+        self.versions = []
         for i in (1, 2, 3):
             try:
                 versions = yield self.client.read_input_registers(1000, 10, unit=i)
@@ -234,6 +505,27 @@ class Neuron(object):
                 pass
         yield config.add_aliases(alias_dict)
 
+    @gen.coroutine
+    def resync(self, alias_dict):
+        """ Called after a reconnect instead of readboards(): keeps the boards and their devices if their
+              version registers did not change and only makes the register cache re-read on the next scan
+        """
+        changed = len(self.boards) == 0
+        for board in self.boards:
+            if changed:
+                break
+            try:
+                versions = yield self.client.read_input_registers(1000, 10, unit=board.circuit)
+                changed = isinstance(versions, ExceptionResponse) or list(versions.registers[:4]) != list(board.versions[:4])
+            except Exception, E:
+                logger.exception(str(E))
+                changed = True
+        if changed:
+            logger.info("SPI boards changed, reading them again")
+            yield self.readboards(alias_dict)
+        elif self.modbus_cache_map is not None:
+            self.modbus_cache_map.refresh()
+
     def start_scanning(self):
         self.do_scanning = True
         if not self.is_scanning:
@@ -281,10 +573,59 @@ class Neuron(object):
             self.is_scanning = False
 
 
+class SlaveHealth(object):
+    """ Communication health of one Modbus slave
+          A scan with any request left without a response is failed, the latency is taken from the answered ones.
+          After QUARANTINE_AFTER_FAILURES failed scans the slave is quarantined: it is probed with a single
+          request after a back-off growing from QUARANTINE_MIN_BACKOFF to QUARANTINE_MAX_BACKOFF seconds
+          and scanned fully again as soon as it answers
+    """
+    def __init__(self, modbus_address):
+        self.modbus_address = modbus_address
+        self.failures = 0               # consecutive failed scans
+        self.latency = None             # [s] moving average of one request
+        self.backoff = 0
+        self.quarantine_until = 0
+
+    @property
+    def quarantined(self):
+        return self.backoff > 0
+
+    def due(self, now):
+        return self.backoff == 0 or now >= self.quarantine_until
+
+    def success(self):
+        if self.backoff > 0:
+            self.backoff = 0
+            self.quarantine_until = 0
+        self.failures = 0
+
+    def observe_latency(self, latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_EWMA_WEIGHT * (latency - self.latency)
+
+    def failure(self, now):
+        self.failures += 1
+        if self.failures >= QUARANTINE_AFTER_FAILURES:
+            if self.backoff == 0:
+                logger.info("Modbus slave %d does not respond, probing it every %d s at most" % (self.modbus_address, QUARANTINE_MAX_BACKOFF))
+                self.backoff = QUARANTINE_MIN_BACKOFF
+            else:
+                self.backoff = min(QUARANTINE_MAX_BACKOFF, self.backoff * 2)
+            self.quarantine_until = now + self.backoff
+
+    def full(self):
+        return {'comm_failures': self.failures,
+                'comm_latency': self.latency,
+                'quarantined': self.quarantined}
+
+
 class ModbusNeuron(object):
 
     def __init__(self, circuit, Config, scan_freq, scan_enabled, hw_dict, modbus_address=15,
-                       major_group=1, device_name='unspecified', direct_access=False, dev_id=0):
+                       major_group=1, device_name='unspecified', direct_access=False, dev_id=0, pipeline_window=1):
         self.alias = ""
         self.devtype = NEURON
         self.modbus_cache_map = None
@@ -306,6 +647,9 @@ class ModbusNeuron(object):
         else:
             self.scan_interval = 1.0 / scan_freq
         self.scan_enabled = scan_enabled
+        self.pipeline_window = pipeline_window
+        self.writer = WriteScheduler(self)
+        self.health = SlaveHealth(modbus_address)
         self.versions = []
         self.logfile = Config.getstringdef("MAIN", "log_file", "/var/log/evok.log")
 
@@ -348,6 +692,25 @@ class ModbusNeuron(object):
             logger.exception(str(E))
             pass
 
+    @gen.coroutine
+    def resync(self, alias_dict):
+        """ Called after a reconnect instead of readboards(): keeps the board and its devices if its
+              version registers did not change and only makes the register cache re-read on the next scan
+        """
+        changed = len(self.boards) == 0
+        if not changed:
+            try:
+                versions = yield self.client.read_input_registers(1000, 10, unit=self.modbus_address)
+                changed = isinstance(versions, (ExceptionResponse, AsyncErrorResponse)) or list(versions.registers[:4]) != list(self.versions[:4])
+            except Exception, E:
+                logger.exception(str(E))
+                changed = True
+        if changed:
+            logger.info("Modbus board on Modbus address %d changed, reading it again" % self.modbus_address)
+            yield self.readboards(alias_dict)
+        elif self.modbus_cache_map is not None:
+            self.modbus_cache_map.refresh()
+
     def start_scanning(self):
         self.do_scanning = True
         if not self.is_scanning:
@@ -359,17 +722,39 @@ class ModbusNeuron(object):
             self.do_scanning = False
 
     @gen.coroutine
-    def scan_boards(self, invoc=False):
-        if self.is_scanning and invoc:
+    def scan_once(self):
+        if self.modbus_cache_map is None or not self.health.due(time.time()):
             raise gen.Return()
         try:
-            if self.modbus_cache_map is not None:
-                yield self.modbus_cache_map.do_scan(unit=self.modbus_address)
-                self.scanning_error_triggered = False
+            if self.health.quarantined:
+                # A single register tells whether a full scan is worth the wait
+                probe = yield self.client.read_input_registers(1000, 1, unit=self.modbus_address)
+                if isinstance(probe, AsyncErrorResponse):
+                    self.health.failure(time.time())
+                    raise gen.Return()
+                logger.info("Modbus slave %d responds again" % self.modbus_address)
+            (answered, failed, answered_time) = yield self.modbus_cache_map.do_scan(unit=self.modbus_address)
+            if answered > 0:
+                self.health.observe_latency(answered_time / answered)
+            # A slave answering only some requests still stalls the bus on the others
+            if failed > 0:
+                self.health.failure(time.time())
+            elif answered > 0:
+                self.health.success()
+            self.scanning_error_triggered = False
+        except gen.Return:
+            raise
         except Exception, E:
+            self.health.failure(time.time())
             if not self.scanning_error_triggered:
                 logger.debug(str(E))
             self.scanning_error_triggered = True
+
+    @gen.coroutine
+    def scan_boards(self, invoc=False):
+        if self.is_scanning and invoc:
+            raise gen.Return()
+        yield self.scan_once()
         if self.do_scanning and (self.scan_interval != 0):
             self.loop.call_later(self.scan_interval, self.scan_boards)
             self.is_scanning = True
@@ -390,6 +775,7 @@ class UartNeuron(ModbusNeuron):
         self.parity = parity
         self.stopbits = stopbits
         self.neuron_uart_circuit = neuron_uart_circuit
+        self.bus = None
 
     def switch_to_async(self, loop, alias_dict):
         self.loop = loop
@@ -398,7 +784,16 @@ class UartNeuron(ModbusNeuron):
         else:
             self.client = modbusclient_rs485.AsyncModbusGeneratorClient(method='rtu', stopbits=self.stopbits, bytesize=8, parity=self.parity, baudrate=self.baud_rate, timeout=1.5, port=self.port)
             modbusclient_rs485.client_dict[self.port] = self.client
-        loop.add_callback(lambda: modbusclient_rs485.UartStartClient(self, self.readboards, callback_args=alias_dict))
+        if self.port not in modbusclient_rs485.bus_dict:
+            modbusclient_rs485.bus_dict[self.port] = modbusclient_rs485.UartBus(self.port)
+        self.bus = modbusclient_rs485.bus_dict[self.port]
+        self.bus.add(self, self.readboards, callback_args=alias_dict)
+
+    def start_scanning(self):
+        """ Scans are scheduled by the UartBus of the port, starting only shortens the scan period """
+        self.do_scanning = True
+        if self.bus is not None:
+            self.bus.wake(self)
 
 
     def full(self):
@@ -413,25 +808,30 @@ class UartNeuron(ModbusNeuron):
             ret['alias'] = self.alias
         if self.modbus_cache_map is not None:
             ret['last_comm'] = time.time() - self.modbus_cache_map.last_comm_time
+        ret.update(self.health.full())
         return ret
 
 
 class TcpNeuron(ModbusNeuron):
 
     def __init__(self, circuit, Config, modbus_server, modbus_port, scan_freq, scan_enabled, hw_dict, 
-                 modbus_address=1, major_group=1, device_name='unspecified', direct_access=False, dev_id=0):
+                 modbus_address=1, major_group=1, device_name='unspecified', direct_access=False, dev_id=0, pipeline_window=1,
+                 modbus_sockets=1, modbus_request_timeout=5.0):
         ModbusNeuron.__init__(self,circuit, Config, scan_freq, scan_enabled, hw_dict, modbus_address,
-                              major_group, device_name, direct_access, dev_id)
+                              major_group, device_name, direct_access, dev_id, pipeline_window)
         self.circuit = circuit; #"EXT_" + str(modbus_address)
         self.modbus_server = modbus_server
         self.modbus_port = modbus_port
+        self.modbus_sockets = modbus_sockets
+        self.modbus_request_timeout = modbus_request_timeout
 
 
     def switch_to_async(self, loop, alias_dict):
         self.loop = loop
-        self.client = ModbusClientProtocol()
-        loop.add_callback(lambda: StartClient(self.client, self.modbus_server, self.modbus_port,
-                                              self.readboards, callback_args=alias_dict))
+        self.client = modbusclient_tornado.get_pool(self.modbus_server, self.modbus_port, self.modbus_sockets,
+                                                    self.modbus_request_timeout)
+        self.client.add_connect_callback(self.readboards, callback_args=alias_dict, resync=self.resync)
+        loop.add_callback(self.client.start)
 
     def full(self):
         ret = {'dev': 'extension',
@@ -445,6 +845,7 @@ class TcpNeuron(ModbusNeuron):
             ret['alias'] = self.alias
         if self.modbus_cache_map is not None:
             ret['last_comm'] = time.time() - self.modbus_cache_map.last_comm_time
+        ret.update(self.health.full())
         return ret
 
 
@@ -808,6 +1209,7 @@ class Board(object):
         self.direct_access = direct_access
         self.legacy_mode = not (Config.getbooldef('MAIN','use_experimental_api', False))
         self.modbus_address = 0
+        self.versions = versions
         self.sw = versions[0]
         self.neuron = neuron
         self.major_group = major_group
@@ -1164,7 +1566,7 @@ class Relay(object):
         if self.pending_id:
             IOLoop.instance().remove_timeout(self.pending_id)
             self.pending_id = None
-        yield self.arm.neuron.client.write_coil(self.coil, 1 if value else 0, unit=self.arm.modbus_address)
+        yield self.arm.neuron.writer.write_coil(self.coil, 1 if value else 0, unit=self.arm.modbus_address)
         raise gen.Return(1 if value else 0)
 
     def value_delta(self, new_val):
@@ -1211,9 +1613,9 @@ class Relay(object):
                 #    self.pwm_duty_val = 0
                 #    self.arm.neuron.client.write_register(self.pwmdutyreg, self.pwm_duty_val, unit=self.arm.modbus_address)
 
-                self.arm.neuron.client.write_register(self.pwmcyclereg, self.pwm_cycle_val - 1, unit=self.arm.modbus_address)
-                self.arm.neuron.client.write_register(self.pwmprescalereg, self.pwm_prescale_val, unit=self.arm.modbus_address)
-                self.arm.neuron.client.write_register(self.pwmdutyreg, self.pwm_duty_val, unit=self.arm.modbus_address)
+                self.arm.neuron.writer.write_register(self.pwmcyclereg, self.pwm_cycle_val - 1, unit=self.arm.modbus_address)
+                self.arm.neuron.writer.write_register(self.pwmprescalereg, self.pwm_prescale_val, unit=self.arm.modbus_address)
+                self.arm.neuron.writer.write_register(self.pwmdutyreg, self.pwm_duty_val, unit=self.arm.modbus_address)
 
                 other_devs = Devices.by_int(RELAY, major_group=self.major_group)  # All PWM outs in the same group share this registers
                 for other_dev in other_devs:
@@ -1229,7 +1631,7 @@ class Relay(object):
                 for preset, freq in Relay.PWM_PRESET_MAP.iteritems():
                     if int(pwm_freq) == freq:
                         self.pwm_preset = preset
-                        self.arm.neuron.client.write_register(self.pwmpresetreg, self.pwm_preset,
+                        self.arm.neuron.writer.write_register(self.pwmpresetreg, self.pwm_preset,
                                                               unit=self.arm.modbus_address)
                         break
 
@@ -1255,10 +1657,10 @@ class Relay(object):
                 timeout = float(timeout)
 
             self.mode = 'Simple'
-            self.arm.neuron.client.write_coil(self.coil, parsed_value, unit=self.arm.modbus_address)
+            self.arm.neuron.writer.write_coil(self.coil, parsed_value, unit=self.arm.modbus_address)
             if self.pwm_duty != 0:
                 self.pwm_duty = 0
-                self.arm.neuron.client.write_register(self.pwmdutyreg, self.pwm_duty, unit=self.arm.modbus_address) # Turn off PWM
+                self.arm.neuron.writer.write_register(self.pwmdutyreg, self.pwm_duty, unit=self.arm.modbus_address) # Turn off PWM
 
         # Set PWM Duty
         elif pwm_duty is not None and 0.0 <= float(pwm_duty) <= 100.0:
@@ -1269,8 +1671,8 @@ class Relay(object):
                 self.pwm_duty_val = int(self.pwm_duty)
 
             if self.value != 0:
-                self.arm.neuron.client.write_coil(self.coil, 0, unit=self.arm.modbus_address)
-            self.arm.neuron.client.write_register(self.pwmdutyreg, self.pwm_duty_val, unit=self.arm.modbus_address)
+                self.arm.neuron.writer.write_coil(self.coil, 0, unit=self.arm.modbus_address)
+            self.arm.neuron.writer.write_register(self.pwmdutyreg, self.pwm_duty_val, unit=self.arm.modbus_address)
             self.mode = 'PWM'
 
         if alias is not None:
@@ -1285,7 +1687,7 @@ class Relay(object):
 
         def timercallback():
             self.pending_id = None
-            self.arm.neuron.client.write_coil(self.coil, 0 if value else 1, unit=self.arm.modbus_address)
+            self.arm.neuron.writer.write_coil(self.coil, 0 if value else 1, unit=self.arm.modbus_address)
 
         self.pending_id = IOLoop.instance().add_timeout(
             datetime.timedelta(seconds=float(timeout)), timercallback)
@@ -1344,7 +1746,7 @@ class ULED(object):
     def set_state(self, value):
         """ Sets new on/off status. Disable pending timeouts
         """
-        yield self.arm.neuron.client.write_coil(self.coil, 1 if value else 0, unit=self.arm.modbus_address)
+        yield self.arm.neuron.writer.write_coil(self.coil, 1 if value else 0, unit=self.arm.modbus_address)
         raise gen.Return(1 if value else 0)
 
     @gen.coroutine
@@ -1356,7 +1758,7 @@ class ULED(object):
                 self.alias = alias
         if value is not None:
             value = int(value)
-            self.arm.neuron.client.write_coil(self.coil, 1 if value else 0, unit=self.arm.modbus_address)
+            self.arm.neuron.writer.write_coil(self.coil, 1 if value else 0, unit=self.arm.modbus_address)
         raise gen.Return(self.full())
 
     def get(self):
@@ -1515,7 +1917,7 @@ class Watchdog(object):
         self.arm = arm
         self.major_group = major_group
         self.legacy_mode = legacy_mode
-        self.timeoutvalue = lambda: self.arm.neuron.modbus_cache_map.get_register(1, self.toreg, unit=self.arm.modbus_address)
+        self.timeoutvalue = lambda: list(self.arm.neuron.modbus_cache_map.get_register(1, self.toreg, unit=self.arm.modbus_address))
         self.regvalue = lambda: self.arm.neuron.modbus_cache_map.get_register(1, self.toreg, unit=self.arm.modbus_address)[0]
         self.nvsavvalue = 0
         self.resetvalue = 0
@@ -1861,7 +2263,7 @@ class Register():
     def set_state(self, value):
         """ Sets new on/off status. Disable pending timeouts
         """
-        self.arm.neuron.client.write_register(self.valreg, value if value else 0, unit=self.arm.modbus_address)
+        self.arm.neuron.writer.write_register(self.valreg, value if value else 0, unit=self.arm.modbus_address)
         raise gen.Return(value if value else 0)
 
     @gen.coroutine
@@ -1873,7 +2275,7 @@ class Register():
                 self.alias = alias
         if value is not None:
             value = int(value)
-            self.arm.neuron.client.write_register(self.valreg, value if value else 0, unit=self.arm.modbus_address)
+            self.arm.neuron.writer.write_register(self.valreg, value if value else 0, unit=self.arm.modbus_address)
 
         raise gen.Return(self.full())
 
@@ -3,7 +3,7 @@
 import tornado
 import tornado.ioloop
 
-from tornadorpc_evok.json import JSONRPCHandler
+from tornadorpc_evok.json import JSONRPCHandler, JSONRPCParser, JSONRPCLibraryWrapper
 import tornadorpc_evok as tornadorpc
 from tornado import gen
 
@@ -12,6 +12,7 @@ import datetime
 import json
 
 import config
+import codec
 
 from devices import *
 
@@ -43,7 +44,15 @@ class userBasicHelper():
             self._request_auth()
 
 
+class CodecLibraryWrapper(JSONRPCLibraryWrapper):
+    """ JSON-RPC messages are encoded by the codec of the web API """
+    jdumps = staticmethod(lambda obj, encoding='utf-8': codec.dumps(obj))
+    jloads = staticmethod(codec.loads)
+
+
 class Handler(userBasicHelper, JSONRPCHandler):
+    _RPC_ = JSONRPCParser(CodecLibraryWrapper)
+
     @tornado.web.authenticated
     def post(self):
         JSONRPCHandler.post(self)
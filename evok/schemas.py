@@ -292,7 +292,14 @@ neuron_get_out_schema = {
             "alias": {
                 "type": "string"
             },
-            "last_comm": {}
+            "last_comm": {},
+            "comm_failures": {
+                "type": "number"
+            },
+            "comm_latency": {},
+            "quarantined": {
+                "type": "boolean"
+            }
         },
         "required": [
             "dev",
@@ -745,6 +752,13 @@ all_get_out_schema = {
                         "last_comm": {
                             "type": "number"
                         },
+                        "comm_failures": {
+                            "type": "number"
+                        },
+                        "comm_latency": {},
+                        "quarantined": {
+                            "type": "boolean"
+                        },
                         "alias": {
                             "type": "string"
                         }
@@ -938,7 +952,14 @@ all_get_out_schema = {
                         "alias": {
                             "type": "string"
                         },
-                        "last_comm": {}
+                        "last_comm": {},
+                        "comm_failures": {
+                            "type": "number"
+                        },
+                        "comm_latency": {},
+                        "quarantined": {
+                            "type": "boolean"
+                        }
                     },
                     "required": [
                         "dev",
@@ -0,0 +1,221 @@
+'''
+  Materialized device lists served by /rest/all and /json/all, change log of /rest/changes
+------------------------------------------
+'''
+import time
+import datetime
+from collections import OrderedDict, deque
+from tornado import gen
+from tornado.concurrent import Future
+
+from devices import *
+import codec
+
+# Device types whose state changes are reported by devents.status, their encoded state is reused until an event arrives
+EVENT_DRIVEN_TYPES = (INPUT, RELAY, OUTPUT, AI, AO, SENSOR, LED, WATCHDOG, REGISTER)
+
+STREAM_CHUNK_DEVICES = 50       # devices encoded between two returns to the IOLoop
+STREAM_CHUNK_BYTES = 16384      # size of the pieces a large response body is flushed in
+
+
+@gen.coroutine
+def encode_devices(devices, dev_filter=None, binary=None):
+    """ Encodes full() of devices into a JSON list, returning to the IOLoop after every STREAM_CHUNK_DEVICES devices
+          Devices with full() None or, with dev_filter, of other than the listed types are left out
+          With binary (a codec.BinaryCodec) the list is encoded by it instead.
+          The result is one WebSocket message, which tornado sends as a single frame; HTTP responses use write_devices()
+    """
+    parts = []
+    for index in range(len(devices)):
+        dev_full = devices[index].full()
+        if dev_full is not None and (dev_filter is None or dev_full['dev'] in dev_filter):
+            if binary is None:
+                parts += [codec.dumps(dev_full)]
+            else:
+                parts += [codec.compact(dev_full)]
+        if index % STREAM_CHUNK_DEVICES == STREAM_CHUNK_DEVICES - 1:
+            yield gen.moment
+    if binary is not None:
+        raise gen.Return(binary.dumps(parts))
+    raise gen.Return('[' + ', '.join(parts) + ']')
+
+
+@gen.coroutine
+def write_devices(handler, parts):
+    """ Writes encoded devices to a response as one JSON list without joining them first,
+          flushing every STREAM_CHUNK_BYTES
+    """
+    handler.write('[')
+    pending = 1
+    for index in range(len(parts)):
+        if index > 0:
+            handler.write(', ')
+            pending += 2
+        handler.write(parts[index])
+        pending += len(parts[index])
+        if pending >= STREAM_CHUNK_BYTES:
+            pending = 0
+            yield handler.flush()
+    handler.write(']')
+
+
+class DeviceSnapshot(object):
+    """ Pre-encoded full() of all devices of the given types, written as one JSON list by write_devices()
+          Encoded devices of EVENT_DRIVEN_TYPES are kept until a status/config event of the device,
+          full() of all other devices is compared with the cached one on every rebuild and encoded only if it differs.
+          Devices of EVENT_DRIVEN_TYPES are compared the same way once per max_age and after invalidate(),
+          which is called on changes not reported by events (e.g. aliases).
+    """
+    def __init__(self, devtypes, sorted_types=(), max_age=1.0):
+        self.devtypes = devtypes
+        self.sorted_types = sorted_types    # types encoded with sorted keys for better reading
+        self.max_age = max_age
+        self.version = 0                    # bumped by every event
+        self.fragments = {}                 # device -> (full(), encoded full())
+        self.checked_time = 0               # last comparison of all devices with their cached full()
+        self.parts = None                   # encoded full() of every device, in order
+        self.result = None                  # list of full() the parts were encoded from
+        self.body_version = -1
+        self.body_time = 0
+        self.etag = None
+        self.epoch = int(time.time())       # keeps etags of different runs apart
+        self.changes = 0                    # bumped by every build resulting in a different list
+        self.building = None                # future of the rebuild in progress
+
+    def on_event(self, event):
+        for single_dev in event.devices:
+            self.fragments.pop(single_dev, None)
+        self.version += 1
+
+    def invalidate(self):
+        """ Makes the next request rebuild the body with every device compared with its cached full() """
+        self.checked_time = 0
+        self.version += 1
+
+    def encode(self, devtype, dev_full):
+        if devtype in self.sorted_types:
+            return codec.dumps(dev_full, sort_keys=True)
+        return codec.dumps(dev_full)
+
+    @gen.coroutine
+    def get(self):
+        """ Returns (parts, etag), rebuilding the parts only if an event arrived or they are older than max_age """
+        yield self.update()
+        raise gen.Return((self.parts, self.etag))
+
+    @gen.coroutine
+    def get_list(self):
+        """ Returns the list of full() the current parts were encoded from """
+        yield self.update()
+        raise gen.Return(self.result)
+
+    @gen.coroutine
+    def update(self):
+        if self.parts is not None and self.body_version == self.version and time.time() - self.body_time < self.max_age:
+            return
+        building = self.building
+        if building is None:
+            building = self.build()
+            self.building = building
+        try:
+            yield building
+        finally:
+            if self.building is building:
+                self.building = None
+
+    @gen.coroutine
+    def build(self):
+        now = time.time()
+        recheck = now - self.checked_time >= self.max_age
+        if recheck:
+            self.checked_time = now
+        version = self.version
+        fragments = []
+        seen = set()
+        checked = 0
+        for devtype in self.devtypes:
+            for device in Devices.by_int(devtype):
+                seen.add(device)
+                cached = self.fragments.get(device)
+                if cached is None or recheck or devtype not in EVENT_DRIVEN_TYPES:
+                    dev_full = device.full()
+                    if cached is None or dev_full != cached[0]:
+                        cached = (dev_full, self.encode(devtype, dev_full))
+                        self.fragments[device] = cached
+                    checked += 1
+                fragments += [cached]
+                if checked >= STREAM_CHUNK_DEVICES:
+                    # Events arriving meanwhile drop their fragments and leave these parts outdated by version
+                    checked = 0
+                    yield gen.moment
+        for device in [device for device in self.fragments if device not in seen]:
+            del self.fragments[device]
+        parts = [part for (dev_full, part) in fragments]
+        if parts != self.parts:
+            # The etag follows the content, a client polling less often than max_age still gets 304 while nothing changes
+            self.changes += 1
+            self.etag = '"%x-%d"' % (self.epoch, self.changes)
+        self.result = [dev_full for (dev_full, part) in fragments]
+        self.parts = parts
+        self.body_version = version
+        self.body_time = now
+
+
+class ChangeLog(object):
+    """ Ring buffer of the devices reported by status/config events, numbered by a monotonic version
+          Clients get the version as token "<epoch>:<version>", the epoch tells tokens of previous runs apart
+    """
+    def __init__(self, size=1024):
+        self.epoch = '%x' % int(time.time() * 1000)
+        self.version = 0
+        self.entries = deque(maxlen=size)    # (version, device)
+        self.waiters = []
+
+    def on_event(self, event):
+        for single_dev in event.devices:
+            self.version += 1
+            self.entries.append((self.version, single_dev))
+        waiters = self.waiters
+        self.waiters = []
+        for future in waiters:
+            if not future.done():
+                future.set_result(self.version)
+
+    def token(self):
+        return '%s:%d' % (self.epoch, self.version)
+
+    def parse_token(self, token):
+        """ Returns the version of a token issued by this run, None for tokens of other runs """
+        (epoch, sep, version) = token.partition(':')
+        if sep != ':' or epoch != self.epoch:
+            return None
+        return int(version)
+
+    def since(self, version):
+        """ Returns devices changed after version, each once and in order of their last change
+              None means the client is too far behind (or from a previous run) and has to resync
+        """
+        if version is None or version < 0 or version > self.version:
+            return None
+        if version == self.version:
+            return []
+        if len(self.entries) == 0 or version < self.entries[0][0] - 1:
+            return None
+        devices = OrderedDict()
+        for (entry_version, single_dev) in reversed(self.entries):
+            if entry_version <= version:
+                break
+            if single_dev not in devices:
+                devices[single_dev] = entry_version
+        return list(reversed(devices.keys()))
+
+    @gen.coroutine
+    def wait(self, timeout):
+        """ Parks until the next event or timeout seconds """
+        future = Future()
+        self.waiters += [future]
+        try:
+            yield gen.with_timeout(datetime.timedelta(seconds=timeout), future)
+        except gen.TimeoutError:
+            if future in self.waiters:
+                self.waiters.remove(future)
@@ -0,0 +1,104 @@
+'''
+  Webhook delivery - bounded queue, batching, limited concurrency and retries
+------------------------------------------
+'''
+from collections import deque
+import tornado.httpclient
+import tornado.ioloop
+from tornado import gen
+
+from log import *
+
+
+class WebhookQueue(object):
+    """ Delivers webhook notifications to one url
+          Bodies (JSON lists of devices) waiting for delivery are merged into one POST of up to batch_size events;
+          without complex events any number of waiting events is sent as a single GET.
+          A batch is sent once batch_size events wait or the oldest waited linger_ms, at most max_concurrent
+          requests are open at a time (order is kept only with max_concurrent = 1). Failed requests are repeated
+          max_retries times after retry_delay, 2 * retry_delay, ... seconds. When max_queue events wait,
+          the oldest one is dropped.
+    """
+    def __init__(self, url, complex_events, max_queue=1000, batch_size=32, linger_ms=0, max_concurrent=1,
+                 max_retries=3, retry_delay=0.5, request_timeout=10.0):
+        self.http_client = tornado.httpclient.AsyncHTTPClient()
+        self.url = url
+        self.complex_events = complex_events
+        self.max_queue = max(1, max_queue)
+        self.batch_size = max(1, batch_size)
+        self.linger_ms = linger_ms
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.request_timeout = request_timeout
+        self.queue = deque()                # (enqueue time, body)
+        self.in_flight = 0
+        self.linger_timer = None
+        self.delivered = 0
+        self.dropped = 0
+        self.retried = 0
+
+    def put(self, body):
+        if len(self.queue) >= self.max_queue:
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append((tornado.ioloop.IOLoop.current().time(), body))
+        self.pump()
+
+    def pump(self):
+        ioloop = tornado.ioloop.IOLoop.current()
+        while len(self.queue) > 0 and self.in_flight < self.max_concurrent:
+            if self.complex_events and len(self.queue) < self.batch_size and self.linger_ms > 0:
+                deadline = self.queue[0][0] + self.linger_ms / 1000.0
+                if ioloop.time() < deadline:
+                    if self.linger_timer is None:
+                        self.linger_timer = ioloop.call_at(deadline, self.on_linger)
+                    return
+            if self.complex_events:
+                count = min(self.batch_size, len(self.queue))
+            else:
+                count = len(self.queue)
+            if self.linger_timer is not None:
+                # The batch leaves before its linger deadline, the timer would send the next one early
+                ioloop.remove_timeout(self.linger_timer)
+                self.linger_timer = None
+            bodies = [self.queue.popleft()[1] for counter in range(count)]
+            self.in_flight += 1
+            self.deliver(bodies)
+
+    def on_linger(self):
+        self.linger_timer = None
+        self.pump()
+
+    @gen.coroutine
+    def deliver(self, bodies):
+        try:
+            if self.complex_events:
+                # Every body is a JSON list, the batch is sent as one list
+                request = tornado.httpclient.HTTPRequest(self.url, method="POST", request_timeout=self.request_timeout,
+                                                         body='[' + ', '.join(body[1:-1] for body in bodies) + ']')
+            else:
+                request = tornado.httpclient.HTTPRequest(self.url, method="GET", request_timeout=self.request_timeout)
+            for attempt in range(self.max_retries + 1):
+                try:
+                    yield self.http_client.fetch(request)
+                    self.delivered += len(bodies)
+                    break
+                except Exception, E:
+                    if attempt == self.max_retries:
+                        self.dropped += len(bodies)
+                        logger.warning("Webhook %s failed, %d events dropped: %s", self.url, len(bodies), str(E))
+                    else:
+                        self.retried += 1
+                        yield gen.sleep(self.retry_delay * (2 ** attempt))
+        finally:
+            self.in_flight -= 1
+            self.pump()
+
+    def stats(self):
+        return {'url': self.url,
+                'queued': len(self.queue),
+                'in_flight': self.in_flight,
+                'delivered': self.delivered,
+                'dropped': self.dropped,
+                'retried': self.retried}
@@ -0,0 +1,63 @@
+'''
+  Tests of the change log behind /rest/changes
+------------------------------------------
+'''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evok'))
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from snapshot import ChangeLog
+
+
+class Event(object):
+    def __init__(self, *devices):
+        self.devices = list(devices)
+
+
+class ChangeLogTest(AsyncTestCase):
+    def test_since_returns_each_device_once_in_order_of_last_change(self):
+        log = ChangeLog()
+        log.on_event(Event('relay_1'))
+        log.on_event(Event('input_1', 'relay_2'))
+        log.on_event(Event('relay_1'))
+        self.assertEqual(log.since(0), ['input_1', 'relay_2', 'relay_1'])
+        self.assertEqual(log.since(2), ['relay_2', 'relay_1'])
+        self.assertEqual(log.since(log.version), [])
+
+    def test_since_asks_for_resync(self):
+        log = ChangeLog(size=2)
+        for name in ('relay_1', 'relay_2', 'relay_3'):
+            log.on_event(Event(name))
+        self.assertEqual(log.since(None), None)
+        self.assertEqual(log.since(0), None)            # relay_1 already dropped from the ring buffer
+        self.assertEqual(log.since(1), ['relay_2', 'relay_3'])
+        self.assertEqual(log.since(log.version + 1), None)
+
+    def test_token(self):
+        log = ChangeLog()
+        log.on_event(Event('relay_1'))
+        self.assertEqual(log.parse_token(log.token()), 1)
+        self.assertEqual(log.parse_token('0:1'), None)   # issued by another run
+        self.assertEqual(log.parse_token('1'), None)
+
+    @gen_test
+    def test_wait_returns_on_event(self):
+        log = ChangeLog()
+        waiting = log.wait(10)
+        log.on_event(Event('relay_1'))
+        yield waiting
+        self.assertEqual(log.waiters, [])
+
+    @gen_test
+    def test_wait_times_out(self):
+        log = ChangeLog()
+        yield log.wait(0.01)
+        self.assertEqual(log.waiters, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
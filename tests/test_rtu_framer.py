@@ -0,0 +1,92 @@
+'''
+  Tests of the incremental RTU response parser of modbusclient_rs485
+------------------------------------------
+'''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evok'))
+
+from pymodbus.factory import ClientDecoder
+from pymodbus.pdu import ExceptionResponse
+from pymodbus.register_read_message import ReadHoldingRegistersRequest
+from pymodbus.register_write_message import WriteSingleRegisterRequest
+from pymodbus.utilities import computeCRC
+
+from modbusclient_rs485 import AsyncModbusRtuFramer
+
+
+def frame(data):
+    """ Appends the CRC to unit, function code and data """
+    data = bytearray(data)
+    crc = computeCRC(bytes(data))
+    return bytes(data + bytearray([crc >> 8, crc & 0xff]))
+
+
+class RtuFramerTest(unittest.TestCase):
+    def setUp(self):
+        self.framer = AsyncModbusRtuFramer(ClientDecoder())
+        self.results = []
+
+    def feed(self, data):
+        self.framer.addToFrame(data)
+        self.framer.processIncomingPacket(data, self.results.append)
+
+    def test_read_response(self):
+        self.framer.expect(ReadHoldingRegistersRequest(0, 2, unit=1))
+        self.feed(frame([1, 3, 4, 0, 10, 0, 20]))
+        self.assertEqual(len(self.results), 1)
+        self.assertEqual(self.results[0].registers, [10, 20])
+        self.assertEqual(self.results[0].unit_id, 1)
+        self.assertEqual(self.framer.getFrameLen(), 0)
+
+    def test_partial_frame_waits_for_the_rest(self):
+        self.framer.expect(ReadHoldingRegistersRequest(0, 2, unit=1))
+        data = frame([1, 3, 4, 0, 10, 0, 20])
+        self.feed(data[:5])
+        self.assertEqual(self.results, [])
+        self.feed(data[5:])
+        self.assertEqual(len(self.results), 1)
+        self.assertEqual(self.results[0].registers, [10, 20])
+
+    def test_fixed_length_write_response(self):
+        self.framer.expect(WriteSingleRegisterRequest(5, 7, unit=1))
+        self.feed(frame([1, 6, 0, 5, 0, 7]))
+        self.assertEqual(len(self.results), 1)
+        self.assertEqual(self.results[0].address, 5)
+        self.assertEqual(self.results[0].value, 7)
+
+    def test_exception_response(self):
+        self.framer.expect(ReadHoldingRegistersRequest(0, 2, unit=1))
+        self.feed(frame([1, 0x83, 2]))
+        self.assertEqual(len(self.results), 1)
+        self.assertTrue(isinstance(self.results[0], ExceptionResponse))
+        self.assertEqual(self.results[0].exception_code, 2)
+
+    def test_leading_noise_is_skipped(self):
+        self.framer.expect(ReadHoldingRegistersRequest(0, 1, unit=1))
+        self.feed(b'\x00\xff\x03' + frame([1, 3, 2, 0, 42]))
+        self.assertEqual(len(self.results), 1)
+        self.assertEqual(self.results[0].registers, [42])
+
+    def test_reply_of_other_unit_is_skipped(self):
+        self.framer.expect(ReadHoldingRegistersRequest(0, 1, unit=1))
+        self.feed(frame([2, 3, 2, 0, 13]) + frame([1, 3, 2, 0, 42]))
+        self.assertEqual(len(self.results), 1)
+        self.assertEqual(self.results[0].unit_id, 1)
+        self.assertEqual(self.results[0].registers, [42])
+
+    def test_bad_crc_is_skipped(self):
+        self.framer.expect(ReadHoldingRegistersRequest(0, 1, unit=1))
+        corrupted = bytearray(frame([1, 3, 2, 0, 13]))
+        corrupted[-1] ^= 0xff
+        self.feed(bytes(corrupted))
+        self.assertEqual(self.results, [])
+        self.feed(frame([1, 3, 2, 0, 42]))
+        self.assertEqual(len(self.results), 1)
+        self.assertEqual(self.results[0].registers, [42])
+
+
+if __name__ == '__main__':
+    unittest.main()
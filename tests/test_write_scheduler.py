@@ -0,0 +1,115 @@
+'''
+  Tests of coalescing coil and register writes into write_coils/write_registers requests
+------------------------------------------
+'''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'evok'))
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+from pymodbus.pdu import ExceptionResponse
+
+import config     # imported before neuron, as evok.py does, to resolve their circular import
+from neuron import WriteScheduler, plan_write_runs
+
+
+class RecordingClient(object):
+    """ Records the requests sent, units in refusing answer write_coils/write_registers with an exception """
+    def __init__(self, refusing=()):
+        self.refusing = refusing
+        self.requests = []
+
+    @gen.coroutine
+    def request(self, name, address, value, unit):
+        self.requests += [(name, address, value, unit)]
+        if name in ('write_coils', 'write_registers') and unit in self.refusing:
+            raise gen.Return(ExceptionResponse(15 if name == 'write_coils' else 16, 1))
+        raise gen.Return(name)
+
+    def write_coil(self, address, value, unit=0):
+        return self.request('write_coil', address, value, unit)
+
+    def write_coils(self, address, values, unit=0):
+        return self.request('write_coils', address, values, unit)
+
+    def write_register(self, address, value, unit=0):
+        return self.request('write_register', address, value, unit)
+
+    def write_registers(self, address, values, unit=0):
+        return self.request('write_registers', address, values, unit)
+
+
+class FakeNeuron(object):
+    def __init__(self, client):
+        self.client = client
+
+
+class PlanWriteRunsTest(unittest.TestCase):
+    def test_contiguous_addresses_form_one_run(self):
+        runs = plan_write_runs({3: [30, 'c'], 1: [10, 'a'], 2: [20, 'b'], 7: [70, 'd']}, 10)
+        self.assertEqual(runs, [(1, [10, 20, 30], ['a', 'b', 'c']), (7, [70], ['d'])])
+
+    def test_runs_are_split_at_max_count(self):
+        runs = plan_write_runs({1: [10, 'a'], 2: [20, 'b'], 3: [30, 'c']}, 2)
+        self.assertEqual(runs, [(1, [10, 20], ['a', 'b']), (3, [30], ['c'])])
+
+    def test_without_merge_every_write_is_alone(self):
+        runs = plan_write_runs({1: [10, 'a'], 2: [20, 'b']}, 10, merge=False)
+        self.assertEqual(runs, [(1, [10], ['a']), (2, [20], ['b'])])
+
+
+class WriteSchedulerTest(AsyncTestCase):
+    # flush() is called directly, the callback add() schedules on the global IOLoop finds nothing pending
+
+    @gen_test
+    def test_writes_of_one_iteration_are_merged(self):
+        client = RecordingClient()
+        writer = WriteScheduler(FakeNeuron(client))
+        futures = [writer.write_register(address, address * 10, unit=1) for address in (5, 6, 7)]
+        yield writer.flush()
+        self.assertEqual(client.requests, [('write_registers', 5, [50, 60, 70], 1)])
+        for future in futures:
+            self.assertEqual(future.result(), 'write_registers')
+
+    @gen_test
+    def test_last_write_to_an_address_wins(self):
+        client = RecordingClient()
+        writer = WriteScheduler(FakeNeuron(client))
+        first = writer.write_register(5, 1)
+        second = writer.write_register(5, 2)
+        yield writer.flush()
+        self.assertTrue(first is second)
+        self.assertEqual(client.requests, [('write_register', 5, 2, 0)])
+
+    @gen_test
+    def test_coils_go_before_registers(self):
+        client = RecordingClient()
+        writer = WriteScheduler(FakeNeuron(client))
+        writer.write_register(10, 500)
+        writer.write_coil(0, True)
+        yield writer.flush()
+        self.assertEqual(client.requests, [('write_coil', 0, True, 0), ('write_register', 10, 500, 0)])
+
+    @gen_test
+    def test_refused_merged_write_falls_back_to_single_writes(self):
+        client = RecordingClient(refusing=(2,))
+        writer = WriteScheduler(FakeNeuron(client))
+        futures = [writer.write_coil(address, True, unit=2) for address in (0, 1)]
+        yield writer.flush()
+        self.assertEqual(client.requests, [('write_coils', 0, [True, True], 2),
+                                           ('write_coil', 0, True, 2), ('write_coil', 1, True, 2)])
+        for future in futures:
+            self.assertEqual(future.result(), 'write_coil')
+        self.assertTrue((2, True) in writer.no_merge)
+        client.requests = []
+        writer.write_coil(3, False, unit=2)
+        writer.write_coil(4, False, unit=2)
+        yield writer.flush()
+        self.assertEqual(client.requests, [('write_coil', 3, False, 2), ('write_coil', 4, False, 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
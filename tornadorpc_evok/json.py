@@ -28,17 +28,40 @@ distribution as the "json" module.
 
 from tornadorpc_evok.base import BaseRPCParser, BaseRPCHandler
 import jsonrpclib
-from jsonrpclib.jsonrpc import isbatch, isnotification, Fault
-from jsonrpclib.jsonrpc import dumps, loads
+from jsonrpclib.jsonrpc import isbatch, isnotification, Fault, Payload
+from jsonrpclib.jsonrpc import dumps, loads, jdumps, jloads
 
 
 class JSONRPCParser(BaseRPCParser):
 
     content_type = 'application/json-rpc'
 
+    def loads(self, data):
+        """ Decodes a request by the jloads of the library wrapper """
+        request = self.library.jloads(data)
+        if jsonrpclib.config.use_jsonclass:
+            from jsonrpclib import jsonclass
+            request = jsonclass.load(request)
+        return request
+
+    def dumps(self, response, rpcid=None, version=None):
+        """ Builds the response (or the error of a Fault) and encodes it by the jdumps of the library wrapper """
+        if not version:
+            version = jsonrpclib.config.version
+        payload = Payload(rpcid=rpcid, version=version)
+        if isinstance(response, Fault):
+            return self.library.jdumps(payload.error(response.faultCode, response.faultString))
+        if rpcid is None:
+            # Same check as jsonrpclib.jsonrpc.dumps(), only notifications go without an id and they get no response
+            raise ValueError('A method response must have an rpcid.')
+        if jsonrpclib.config.use_jsonclass:
+            from jsonrpclib import jsonclass
+            response = jsonclass.dump(response)
+        return self.library.jdumps(payload.response(response))
+
     def parse_request(self, request_body):
         #try:
-        request = loads(request_body)
+        request = self.loads(request_body)
         #except:
             # Bad request formatting
         #        self.traceback()
@@ -60,9 +83,9 @@ class JSONRPCParser(BaseRPCParser):
 
     def parse_responses(self, responses):
         if isinstance(responses, Fault):
-            return dumps(responses)
+            return self.dumps(responses)
         if len(responses) != len(self._requests):
-            return dumps(self.faults.internal_error())
+            return self.dumps(self.faults.internal_error())
         response_list = []
         for i in range(0, len(responses)):
             request = self._requests[i]
@@ -76,12 +99,11 @@ class JSONRPCParser(BaseRPCParser):
             if 'jsonrpc' not in request.keys():
                 version = 1.0
             try:
-                response_json = dumps(
-                    response, version=version,
-                    rpcid=rpcid, methodresponse=True
+                response_json = self.dumps(
+                    response, version=version, rpcid=rpcid
                 )
             except TypeError:
-                return dumps(
+                return self.dumps(
                     self.faults.server_error(),
                     rpcid=rpcid, version=version
                 )
@@ -102,6 +124,9 @@ class JSONRPCLibraryWrapper(object):
     dumps = dumps
     loads = loads
     Fault = Fault
+    # JSON encoder and decoder of the messages, replace in a subclass to use another JSON library
+    jdumps = staticmethod(jdumps)
+    jloads = staticmethod(jloads)
 
 
 class JSONRPCHandler(BaseRPCHandler):